@@ -2,8 +2,12 @@ from fastapi import FastAPI, HTTPException, Response
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
 import os
-import glob
-from generate import selenium_dni_async
+import asyncio
+import operator
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from generate import selenium_dni_async, cachear_resultado, verificar_conversor, cerrar_conversor, PDF_OUTPUT_DIR, PDF_PREFIX, PDF_SUFFIX
 import uvicorn
 from typing import Optional
 from cache_manager import cache_manager
@@ -11,6 +15,39 @@ from fastapi import BackgroundTasks
 from cleanup_scheduler import cleanup_manager
 import atexit
 
+# Navegadores de Selenium por host, repartidos entre los WEB_CONCURRENCY workers de uvicorn:
+# cada proceso del pool mantiene un Chrome abierto. Al menos uno por worker
+SELENIUM_PROCESSES = max(1, int(os.getenv("SELENIUM_PROCESSES", 4)) // max(1, int(os.getenv("WEB_CONCURRENCY", 1))))
+
+class PoolSelenium(Executor):
+    """
+    ProcessPoolExecutor que se recrea si un proceso hijo muere (segfault de Chrome,
+    OOM killer...): un pool roto rechaza todo envío posterior con BrokenProcessPool.
+    Los procesos se arrancan con spawn: el worker de uvicorn ya tiene hilos en marcha
+    """
+    
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._pool = self._crear()
+    
+    def _crear(self):
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    
+    def submit(self, fn, /, *args, **kwargs):
+        try:
+            return self._pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            print("⚠️ Pool de procesos de Selenium roto, creando uno nuevo")
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._crear()
+            return self._pool.submit(fn, *args, **kwargs)
+    
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
 app = FastAPI(
     title="Generador de Reportes PDF",
     description="API para generar reportes PDF de créditos usando DNI",
@@ -21,6 +58,18 @@ app = FastAPI(
 @app.on_event("startup")
 async def startup_event():
     """Eventos de inicio de la aplicación"""
+    # Pool acotado para asyncio.to_thread / run_in_executor(None): solo hace E/S de archivos cortas
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+        max_workers=int(os.getenv("PDF_IO_THREADS", 4)),
+        thread_name_prefix="pdf-io"
+    ))
+    # Pool de procesos para Selenium: el trabajo pesado no compite con el event loop
+    app.state.pdf_pool = PoolSelenium(max_workers=SELENIUM_PROCESSES)
+    # Comprobar Node.js al arrancar, fuera del event loop, en lugar de en la primera conversión
+    await asyncio.to_thread(verificar_conversor)
+    # Cargar el índice de cache en memoria una sola vez
+    await cache_manager._ensure_loaded()
+    # Con varios workers solo el que obtiene el lock ejecuta el programador
     cleanup_manager.start_scheduler()
     print("🚀 Aplicación iniciada con limpieza automática activada")
 
@@ -29,6 +78,9 @@ async def startup_event():
 async def shutdown_event():
     """Eventos de cierre de la aplicación"""
     cleanup_manager.stop_scheduler()
+    await cache_manager.flush()
+    await cerrar_conversor()
+    app.state.pdf_pool.shutdown(wait=False, cancel_futures=True)
     print("🛑 Aplicación detenida, limpieza automática desactivada")
 
 # También registrar para cierre del proceso
@@ -61,7 +113,7 @@ async def root():
 async def generate_pdf(request: DNIRequest):
     """Generar PDF y devolver información del archivo - VERSIÓN ASÍNCRONA"""
     try:
-        resultado = await selenium_dni_async(request.dni)
+        resultado = await selenium_dni_async(request.dni, executor=app.state.pdf_pool)
         
         if not resultado.get("success", False):
             raise HTTPException(status_code=500, detail=resultado.get("error", "Error desconocido"))
@@ -77,26 +129,33 @@ async def generate_pdf(request: DNIRequest):
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @app.post("/generate-and-download-pdf")
-async def generate_and_download_pdf(request: DNIRequest):
+async def generate_and_download_pdf(request: DNIRequest, background_tasks: BackgroundTasks):
     """Generar y descargar PDF directamente - VERSIÓN ASÍNCRONA"""
     try:
-        resultado = await selenium_dni_async(request.dni)
+        resultado = await selenium_dni_async(request.dni, executor=app.state.pdf_pool, cache_result=False)
         
         if not resultado.get("success", False):
             raise HTTPException(status_code=500, detail=resultado.get("error", "Error desconocido"))
         
         pdf_path = resultado["filename"]
         
-        if not os.path.exists(pdf_path):
+        # Un solo stat fuera del event loop: comprueba que existe y FileResponse lo reutiliza
+        try:
+            stat_result = await asyncio.to_thread(os.stat, pdf_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"Archivo no encontrado: {pdf_path}")
         
+        # Guardar en cache después de enviar la respuesta, fuera del camino de la petición
+        background_tasks.add_task(cachear_resultado, request.dni, resultado)
+        
         return FileResponse(
             path=pdf_path,
             filename=pdf_path,
             media_type='application/pdf',
             headers={
                 "Content-Disposition": f"attachment; filename={pdf_path}"
-            }
+            },
+            stat_result=stat_result
         )
         
     except HTTPException:
@@ -115,15 +174,20 @@ async def download_pdf(filename: str):
             raise HTTPException(status_code=400, detail="Solo se permiten archivos PDF")
         
         # Construir la ruta completa del archivo
-        file_path = os.path.join("pdfs_generados", filename)
+        file_path = os.path.join(PDF_OUTPUT_DIR, filename)
         
-        if not os.path.exists(file_path):
+        # Un solo stat fuera del event loop: comprueba que existe y FileResponse lo reutiliza
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="Archivo no encontrado")
         
+        # FileResponse envía por bloques y admite Range, ETag y Last-Modified
         return FileResponse(
             path=file_path,
             filename=filename,
-            media_type='application/pdf'
+            media_type='application/pdf',
+            stat_result=stat_result
         )
         
     except HTTPException:
@@ -131,26 +195,32 @@ async def download_pdf(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error descargando archivo: {str(e)}")
 
+def _scan_pdfs(pdf_dir):
+    """Lista los reportes usando os.scandir (un solo stat por archivo)"""
+    pdfs_info = []
+    with os.scandir(pdf_dir) as it:
+        for entry in it:
+            if entry.name.startswith(PDF_PREFIX) and entry.name.endswith(PDF_SUFFIX):
+                file_stats = entry.stat()
+                pdfs_info.append({
+                    "filename": entry.name,
+                    "size_bytes": file_stats.st_size,
+                    "created_timestamp": file_stats.st_ctime,
+                    "download_url": f"/download/{entry.name}"
+                })
+    return pdfs_info
+
 @app.get("/list-pdfs")
 async def list_pdfs():
     """
     Lista todos los PDFs disponibles
     """
     try:
-        pdf_files = glob.glob(os.path.join("pdfs_generados", "reporte_*.pdf"))
-        
-        pdfs_info = []
-        for pdf_file in pdf_files:
-            file_stats = os.stat(pdf_file)
-            pdfs_info.append({
-                "filename": os.path.basename(pdf_file),
-                "size_bytes": file_stats.st_size,
-                "created_timestamp": file_stats.st_ctime,
-                "download_url": f"/download/{os.path.basename(pdf_file)}"
-            })
+        # Recorrer el directorio fuera del event loop
+        pdfs_info = await asyncio.to_thread(_scan_pdfs, PDF_OUTPUT_DIR)
         
         # Ordenar por fecha de creación (más reciente primero)
-        pdfs_info.sort(key=lambda x: x['created_timestamp'], reverse=True)
+        pdfs_info.sort(key=operator.itemgetter("created_timestamp"), reverse=True)
         
         return {
             "total_pdfs": len(pdfs_info),
@@ -216,36 +286,23 @@ async def get_cache_stats():
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-@app.post("/cache/cleanup")
-async def cleanup_cache():
-    """Limpia entradas expiradas del cache - MANUAL"""
-    try:
-        cleaned = await cleanup_manager.cleanup_cache_folder()
-        return {"success": True, "cleaned_entries": cleaned}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
-
-@app.post("/cleanup/full")
-async def full_manual_cleanup():
-    """Ejecuta limpieza completa manual (PDFs + Cache)"""
-    try:
-        result = await cleanup_manager.full_cleanup_task()
-        return {"success": True, "result": result}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
-
-@app.get("/cleanup/status")
-async def get_cleanup_status():
-    """Obtiene el estado del sistema de limpieza automática"""
-    try:
-        next_cleanup = cleanup_manager.get_next_cleanup_time()
-        return {
-            "auto_cleanup_active": cleanup_manager.is_running,
-            "next_cleanup_time": next_cleanup.isoformat() if next_cleanup else None,
-            "cleanup_schedule": "Diario a las 2:00 AM + cada 6 horas"
-        }
-    except Exception as e:
-        return {"error": str(e)}
-
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Los workers heredan WEB_CONCURRENCY y reparten con él los pools por host
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 2) * 2 + 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # uvloop (si está instalado; no existe en Windows) + httptools en producción;
+    # reload desactivado porque no admite múltiples workers
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        workers=workers,
+        reload=False,
+        # Keep-alive largo para clientes que consultan /list-pdfs o /cache/stats periódicamente
+        timeout_keep_alive=75,
+        # El límite de tamaño de cabeceras no se configura aquí (h11_max_incomplete_event_size
+        # solo afecta a h11, no a httptools): aplicarlo en el proxy delante de uvicorn
+        backlog=2048
+    )
\ No newline at end of file
@@ -1,49 +1,215 @@
 import os
-import json
+import orjson
 import time
 import hashlib
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
-import aiofiles
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable, Awaitable
 import asyncio
+import shutil
+import itertools
+import threading
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso, no hace falta lock
+    fcntl = None
+
+# Sufijo único por llamada para los temporales de link_or_copy (varios hilos y procesos a la vez)
+_tmp_counter = itertools.count()
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Crea dst como hardlink de src (sin copiar bytes); si no es posible,
+    por ejemplo entre sistemas de archivos distintos, copia el contenido.
+    Si dst ya es el mismo archivo que src no hace nada.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return
+    except FileNotFoundError:
+        pass
+    
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.{next(_tmp_counter)}.tmp"
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Solo queda si algo falló antes del replace
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
 class PDFCacheManager:
-    def __init__(self, cache_dir: str = "cache", max_age_hours: int = 24):
+    def __init__(self, cache_dir: str = "cache", max_age_hours: int = 24, max_memory_entries: int = 1024):
         self.cache_dir = Path(cache_dir)
         self.max_age_hours = max_age_hours
-        self.memory_cache: Dict[str, Dict[str, Any]] = {}
+        # Capa caliente LRU acotada: al superar el límite se descartan de memoria las
+        # menos usadas, pero siguen en el índice en disco y se recuperan al pedirlas
+        self.memory_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._max_memory_entries = max_memory_entries
         self.cache_file = self.cache_dir / "cache_index.json"
+        # Lock entre workers de uvicorn para leer-fusionar-escribir el índice sin pisarse
+        self.lock_file = self.cache_dir / "cache_index.json.lock"
+        # Cambios de este proceso aún no escritos: altas y bajas (clave -> timestamp de la entrada borrada)
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._deleted: Dict[str, float] = {}
+        self._loaded = False
+        # Última versión leída del índice en disco y su (st_mtime_ns, st_size): solo se
+        # vuelve a leer y parsear cuando otro worker lo reescribe
+        self._disk_index: Dict[str, Any] = {}
+        self._disk_index_sig = None
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        # Estadísticas cacheadas unos segundos (se invalidan en cada modificación)
+        self._stats_cache: Optional[Dict[str, Any]] = None
+        self._stats_cache_ts = 0.0
+        self._stats_ttl_seconds = 5
+        # Generaciones en curso por DNI (singleflight)
+        self._inflight: Dict[str, asyncio.Future] = {}
         
         # Crear directorio de cache si no existe
         self.cache_dir.mkdir(exist_ok=True)
         
     def _get_cache_key(self, dni: str) -> str:
-        """Genera una clave única para el DNI"""
-        return hashlib.md5(dni.encode()).hexdigest()
+        """Genera una clave única para el DNI (hash no criptográfico basta: solo se usa como clave)"""
+        return hashlib.blake2b(dni.encode(), digest_size=8).hexdigest()
     
     def _get_pdf_cache_path(self, cache_key: str) -> Path:
         """Obtiene la ruta del PDF en cache"""
         return self.cache_dir / f"pdf_{cache_key}.pdf"
     
-    async def _load_cache_index(self) -> Dict[str, Any]:
-        """Carga el índice de cache desde disco"""
+    def _read_cache_index(self) -> Dict[str, Any]:
+        """Lee el índice de cache desde disco (bloqueante)"""
         try:
-            if self.cache_file.exists():
-                async with aiofiles.open(self.cache_file, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    return json.loads(content)
+            with open(self.cache_file, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            pass
         except Exception as e:
             print(f"⚠️ Error cargando cache index: {e}")
         return {}
     
-    async def _save_cache_index(self, index: Dict[str, Any]):
-        """Guarda el índice de cache en disco"""
+    def _stat_signature(self):
+        """Identifica la versión del índice en disco sin leerlo (None si no existe)"""
         try:
-            async with aiofiles.open(self.cache_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(index, indent=2, ensure_ascii=False))
+            st = os.stat(self.cache_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+    
+    def _cached_cache_index(self) -> Dict[str, Any]:
+        """Índice en disco ya parseado; un solo stat si nadie lo ha modificado (bloqueante)"""
+        sig = self._stat_signature()
+        if sig != self._disk_index_sig:
+            # stat antes de leer: si cambia entre medias, la próxima llamada lo relee
+            self._disk_index = self._read_cache_index() if sig is not None else {}
+            self._disk_index_sig = sig
+        return self._disk_index
+    
+    async def _load_cache_index(self) -> Dict[str, Any]:
+        """
+        Devuelve el índice de cache en disco, releyéndolo solo si cambió.
+        El diccionario se comparte entre llamadas: no modificarlo
+        """
+        return await asyncio.to_thread(self._cached_cache_index)
+    
+    def _merge_and_save_cache_index(self, pending: Dict[str, Dict[str, Any]], deleted: Dict[str, float]):
+        """
+        Fusiona los cambios de este proceso con el índice en disco y lo guarda
+        (escritura atómica vía rename). El flock serializa a los workers: cada uno
+        relee el índice justo antes de escribir, así nadie pisa las entradas de otro.
+        """
+        with open(self.lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            
+            index = self._read_cache_index()
+            # Solo se borra lo que no haya sido regenerado después por otro worker
+            for cache_key, timestamp in deleted.items():
+                if cache_key in index and index[cache_key]['timestamp'] <= timestamp:
+                    del index[cache_key]
+            for cache_key, cache_entry in pending.items():
+                current = index.get(cache_key)
+                if current is None or current['timestamp'] <= cache_entry['timestamp']:
+                    index[cache_key] = cache_entry
+            
+            # Un temporal por proceso: el lock ya evita escrituras simultáneas, pero no en Windows
+            tmp_file = self.cache_file.with_name(f"{self.cache_file.name}.{os.getpid()}.tmp")
+            try:
+                with open(tmp_file, 'wb') as f:
+                    f.write(orjson.dumps(index, option=orjson.OPT_INDENT_2))
+                    f.flush()
+                    # Asegurar el contenido en disco antes del rename para que un corte no deje un índice vacío
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.cache_file)
+            finally:
+                tmp_file.unlink(missing_ok=True)
+            
+            # Con el lock tomado nadie más ha escrito: lo guardado es la versión actual
+            self._disk_index = index
+            self._disk_index_sig = self._stat_signature()
+    
+    async def _ensure_loaded(self):
+        """Carga una sola vez las entradas más recientes del índice en disco a la capa caliente"""
+        if self._loaded:
+            return
+        self._loaded = True
+        
+        cache_index = await self._load_cache_index()
+        # Insertar de la más antigua a la más reciente para conservar el orden LRU
+        for cache_key, cache_entry in sorted(cache_index.items(), key=lambda item: item[1]['timestamp']):
+            cache_entry['pdf_path'] = str(self._get_pdf_cache_path(cache_key))
+            self.memory_cache.setdefault(cache_key, cache_entry)
+        self._evict_overflow()
+        print(f"📋 Índice de cache cargado: {len(cache_index)} entradas")
+    
+    def _evict_overflow(self):
+        """Descarta de memoria las entradas menos usadas; el índice en disco las conserva"""
+        while len(self.memory_cache) > self._max_memory_entries:
+            self.memory_cache.popitem(last=False)
+    
+    def _mark_dirty(self):
+        """Marca el índice como modificado y programa un guardado diferido"""
+        self._dirty = True
+        self._stats_cache = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+    
+    async def _flush_soon(self, delay: float = 1.0):
+        """Agrupa varias modificaciones seguidas en una sola escritura"""
+        await asyncio.sleep(delay)
+        await self.flush()
+    
+    async def flush(self):
+        """Escribe en disco los cambios pendientes, fusionados con los de otros workers"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        pending, deleted = self._pending, self._deleted
+        self._pending, self._deleted = {}, {}
+        try:
+            await asyncio.to_thread(self._merge_and_save_cache_index, pending, deleted)
         except Exception as e:
             print(f"⚠️ Error guardando cache index: {e}")
+            # Conservar los cambios para el próximo guardado (sin pisar los posteriores)
+            for cache_key, cache_entry in pending.items():
+                if cache_key not in self._deleted:
+                    self._pending.setdefault(cache_key, cache_entry)
+            for cache_key, timestamp in deleted.items():
+                if cache_key not in self._pending:
+                    self._deleted.setdefault(cache_key, timestamp)
+            self._dirty = True
+    
+    def _forget(self, cache_key: str, timestamp: float):
+        """Quita una entrada de memoria y anota su baja para el próximo guardado"""
+        self.memory_cache.pop(cache_key, None)
+        self._pending.pop(cache_key, None)
+        self._deleted[cache_key] = max(timestamp, self._deleted.get(cache_key, timestamp))
     
     def _is_expired(self, timestamp: float) -> bool:
         """Verifica si un elemento del cache ha expirado"""
@@ -53,47 +219,47 @@ class PDFCacheManager:
     async def get_cached_pdf(self, dni: str) -> Optional[Dict[str, Any]]:
         """Obtiene un PDF del cache si existe y no ha expirado"""
         cache_key = self._get_cache_key(dni)
+        await self._ensure_loaded()
         
-        # Verificar cache en memoria primero
         if cache_key in self.memory_cache:
             cache_entry = self.memory_cache[cache_key]
             if not self._is_expired(cache_entry['timestamp']):
+                self.memory_cache.move_to_end(cache_key)
                 print(f"📋 Cache HIT (memoria): {dni}")
                 return cache_entry
             else:
                 # Eliminar entrada expirada de memoria
-                del self.memory_cache[cache_key]
+                self._forget(cache_key, cache_entry['timestamp'])
+                self._mark_dirty()
+                print(f"📋 Cache MISS: {dni}")
+                return None
         
-        # Verificar cache en disco
-        cache_index = await self._load_cache_index()
-        if cache_key in cache_index:
-            cache_entry = cache_index[cache_key]
-            if not self._is_expired(cache_entry['timestamp']):
-                pdf_path = self._get_pdf_cache_path(cache_key)
-                if pdf_path.exists():
-                    # Cargar en memoria para próximas consultas
-                    cache_entry['pdf_path'] = str(pdf_path)
-                    self.memory_cache[cache_key] = cache_entry
-                    print(f"📋 Cache HIT (disco): {dni}")
-                    return cache_entry
+        # Descartada de memoria antes de guardarse, o generada por otro worker: buscar en el índice
+        cache_entry = self._pending.get(cache_key) or (await self._load_cache_index()).get(cache_key)
+        if (cache_entry and cache_entry['timestamp'] > self._deleted.get(cache_key, float('-inf'))
+                and not self._is_expired(cache_entry['timestamp'])):
+            cache_entry['pdf_path'] = str(self._get_pdf_cache_path(cache_key))
+            self.memory_cache[cache_key] = cache_entry
+            self._evict_overflow()
+            print(f"📋 Cache HIT (disco): {dni}")
+            return cache_entry
         
         print(f"📋 Cache MISS: {dni}")
         return None
     
-    async def cache_pdf(self, dni: str, pdf_path: str, metadata: Dict[str, Any] = None) -> bool:
-        """Guarda un PDF en el cache"""
+    async def cache_pdf(self, dni: str, pdf_path: str, metadata: Dict[str, Any] = None,
+                        file_size: Optional[int] = None) -> bool:
+        """Guarda un PDF en el cache. Si el llamador ya conoce file_size, no se vuelve a consultar"""
         try:
+            await self._ensure_loaded()
             cache_key = self._get_cache_key(dni)
             timestamp = time.time()
             
-            # Copiar PDF al directorio de cache
+            # Enlazar (o copiar) el PDF al directorio de cache sin pasar por memoria
             cached_pdf_path = self._get_pdf_cache_path(cache_key)
-            
-            # Copiar archivo PDF
-            async with aiofiles.open(pdf_path, 'rb') as src:
-                content = await src.read()
-                async with aiofiles.open(cached_pdf_path, 'wb') as dst:
-                    await dst.write(content)
+            await asyncio.to_thread(link_or_copy, pdf_path, str(cached_pdf_path))
+            if file_size is None:
+                file_size = await asyncio.to_thread(os.path.getsize, cached_pdf_path)
             
             # Crear entrada de cache
             cache_entry = {
@@ -101,19 +267,18 @@ class PDFCacheManager:
                 'timestamp': timestamp,
                 'pdf_path': str(cached_pdf_path),
                 'original_path': pdf_path,
-                'file_size': len(content),
-                'created_at': datetime.now().isoformat(),
+                'file_size': file_size,
+                'created_at': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp)),
                 'metadata': metadata or {}
             }
             
-            # Guardar en memoria
+            # Guardar en memoria; el índice en disco se actualiza de forma diferida
             self.memory_cache[cache_key] = cache_entry
-            
-            # Actualizar índice en disco
-            cache_index = await self._load_cache_index()
-            cache_index[cache_key] = cache_entry.copy()
-            cache_index[cache_key]['pdf_path'] = str(cached_pdf_path)  # Ruta relativa al cache
-            await self._save_cache_index(cache_index)
+            self.memory_cache.move_to_end(cache_key)
+            self._pending[cache_key] = cache_entry
+            self._deleted.pop(cache_key, None)
+            self._evict_overflow()
+            self._mark_dirty()
             
             print(f"💾 PDF cacheado: {dni} -> {cached_pdf_path}")
             return True
@@ -123,52 +288,79 @@ class PDFCacheManager:
             return False
     
     async def cleanup_expired(self) -> int:
-        """Limpia entradas expiradas del cache"""
-        cleaned_count = 0
+        """Limpia entradas expiradas del cache (en memoria y en el índice en disco)"""
+        await self._ensure_loaded()
         
-        # Limpiar memoria
-        expired_keys = []
-        for key, entry in self.memory_cache.items():
-            if self._is_expired(entry['timestamp']):
-                expired_keys.append(key)
-        
-        for key in expired_keys:
-            del self.memory_cache[key]
-            cleaned_count += 1
+        # Las entradas descartadas de memoria solo están en disco o pendientes de guardar
+        entries = dict(await self._load_cache_index())
+        entries.update(self._pending)
+        entries.update(self.memory_cache)
+        expired = {
+            key: entry['timestamp'] for key, entry in entries.items()
+            if self._is_expired(entry['timestamp'])
+        }
+        expired_keys = list(expired)
         
-        # Limpiar disco
-        cache_index = await self._load_cache_index()
-        expired_disk_keys = []
-        
-        for key, entry in cache_index.items():
-            if self._is_expired(entry['timestamp']):
-                expired_disk_keys.append(key)
-                # Eliminar archivo PDF
-                pdf_path = self._get_pdf_cache_path(key)
-                try:
-                    if pdf_path.exists():
-                        pdf_path.unlink()
-                except Exception as e:
-                    print(f"⚠️ Error eliminando PDF expirado {pdf_path}: {e}")
-        
-        # Actualizar índice
-        for key in expired_disk_keys:
-            del cache_index[key]
-            cleaned_count += 1
-        
-        if expired_disk_keys:
-            await self._save_cache_index(cache_index)
+        # Eliminar los PDFs expirados en paralelo, fuera del event loop
+        results = await asyncio.gather(
+            *[asyncio.to_thread(self._get_pdf_cache_path(key).unlink, missing_ok=True) for key in expired_keys],
+            return_exceptions=True
+        )
+        for key, result in zip(expired_keys, results):
+            if isinstance(result, Exception):
+                print(f"⚠️ Error eliminando PDF expirado {self._get_pdf_cache_path(key)}: {result}")
+            self._forget(key, expired[key])
         
+        cleaned_count = len(expired_keys)
         if cleaned_count > 0:
+            self._mark_dirty()
             print(f"🧹 Cache limpiado: {cleaned_count} entradas expiradas eliminadas")
         
         return cleaned_count
     
+    async def singleflight(self, key: str, producer: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Agrupa las llamadas concurrentes con la misma clave: solo la primera ejecuta
+        producer y las demás esperan y reciben el mismo resultado
+        """
+        fut = self._inflight.get(key)
+        if fut is not None:
+            print(f"⏳ Esperando generación en curso: {key}")
+            # shield: si un llamador que espera se cancela, no cancela la generación compartida
+            return await asyncio.shield(fut)
+        
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await producer()
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # evitar el aviso "exception was never retrieved" si nadie esperaba
+            raise
+        except BaseException:
+            fut.cancel()
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+    
     async def get_cache_stats(self) -> Dict[str, Any]:
         """Obtiene estadísticas del cache"""
-        cache_index = await self._load_cache_index()
+        if self._stats_cache is not None and time.time() - self._stats_cache_ts < self._stats_ttl_seconds:
+            return self._stats_cache
+        
+        await self._ensure_loaded()
+        # Índice completo: lo guardado en disco (por todos los workers) más los cambios sin guardar
+        cache_index = dict(await self._load_cache_index())
+        for cache_key, timestamp in self._deleted.items():
+            if cache_key in cache_index and cache_index[cache_key]['timestamp'] <= timestamp:
+                del cache_index[cache_key]
+        cache_index.update(self._pending)
         
         total_entries = len(cache_index)
+        # Entradas en la capa caliente de este proceso
         memory_entries = len(self.memory_cache)
         
         # Calcular tamaño total
@@ -180,7 +372,7 @@ class PDFCacheManager:
                 valid_entries += 1
                 total_size += entry.get('file_size', 0)
         
-        return {
+        self._stats_cache = {
             'total_entries': total_entries,
             'valid_entries': valid_entries,
             'expired_entries': total_entries - valid_entries,
@@ -189,6 +381,8 @@ class PDFCacheManager:
             'cache_dir': str(self.cache_dir),
             'max_age_hours': self.max_age_hours
         }
+        self._stats_cache_ts = time.time()
+        return self._stats_cache
 
 # Instancia global del cache
 cache_manager = PDFCacheManager(cache_dir="cache", max_age_hours=24)
\ No newline at end of file
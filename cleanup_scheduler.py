@@ -2,47 +2,122 @@ import asyncio
 import os
 import time
 import logging
+import tempfile
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from pdf_converter import PDFConverter
 from cache_manager import cache_manager
-from pathlib import Path
+from generate import PDF_OUTPUT_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso, no hace falta lock
+    fcntl = None
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Lock compartido entre workers de uvicorn para que solo uno programe la limpieza
+SCHEDULER_LOCK_PATH = os.path.join(tempfile.gettempdir(), "selenium_cb_cleanup.lock")
+
+def _is_pdf_or_tmp(name):
+    """Reportes y temporales que link_or_copy pudo dejar (reporte_<dni>.pdf.<pid>...tmp)"""
+    return name.endswith((".pdf", ".tmp"))
+
+def _is_cache_file(name):
+    """PDFs cacheados (pdf_<clave>.pdf) y temporales; nunca el índice ni su lock"""
+    return (name.startswith("pdf_") and name.endswith(".pdf")) or name.endswith(".tmp")
+
 class AutoCleanupManager:
     def __init__(self):
         self.scheduler = AsyncIOScheduler()
         self.pdf_converter = PDFConverter()
         self.is_running = False
+        self._lock_file = None
+    
+    def _acquire_scheduler_lock(self):
+        """Intenta tomar el lock del programador (no bloqueante)"""
+        if fcntl is None:
+            return True
+        try:
+            self._lock_file = open(SCHEDULER_LOCK_PATH, "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if self._lock_file:
+                self._lock_file.close()
+                self._lock_file = None
+            return False
+    
+    def _release_scheduler_lock(self):
+        """Libera el lock del programador si este proceso lo tiene"""
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+    
+    def _scan_expired(self, directory, max_age_seconds, matches=None):
+        """
+        Recorre el directorio en una sola pasada con os.scandir y devuelve los archivos
+        más antiguos que max_age_seconds como tuplas (ruta, nombre, tamaño).
+        matches(nombre) decide qué archivos se consideran.
+        Se ejecuta en un hilo para no bloquear el event loop.
+        """
+        current_time = time.time()
+        to_delete = []
+        
+        with os.scandir(directory) as it:
+            for entry in it:
+                if matches and not matches(entry.name):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat_result = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    # Otro proceso lo eliminó entre readdir y stat
+                    continue
+                if (current_time - stat_result.st_mtime) > max_age_seconds:
+                    to_delete.append((entry.path, entry.name, stat_result.st_size))
+        
+        return to_delete
+    
+    async def _delete_files(self, to_delete):
+        """Elimina los archivos en paralelo desde el pool de hilos (máx. 32 a la vez)"""
+        semaphore = asyncio.Semaphore(32)
+        
+        async def _delete(path, name, size):
+            async with semaphore:
+                try:
+                    await asyncio.to_thread(os.unlink, path)
+                    logger.info(f"🗑️ Archivo eliminado: {name} ({size} bytes)")
+                    return size
+                except FileNotFoundError:
+                    return None
+                except Exception as e:
+                    logger.error(f"⚠️ Error eliminando archivo {path}: {e}")
+                    return None
+        
+        results = await asyncio.gather(*[_delete(*victim) for victim in to_delete])
+        freed = [size for size in results if size is not None]
+        return len(freed), sum(freed)
+    
+    async def _scan_and_delete(self, directory, max_age_seconds, matches=None):
+        """Busca archivos vencidos y los elimina; devuelve (eliminados, bytes liberados)"""
+        to_delete = await asyncio.to_thread(self._scan_expired, directory, max_age_seconds, matches)
+        return await self._delete_files(to_delete)
         
     async def cleanup_pdfs_folder(self):
         """Limpia archivos PDF antiguos (más de 1 día)"""
         try:
-            pdf_dir = "pdfs_generados"
+            pdf_dir = PDF_OUTPUT_DIR
             if not os.path.exists(pdf_dir):
                 logger.info(f"📁 Directorio {pdf_dir} no existe, saltando limpieza")
                 return 0
                 
-            current_time = time.time()
-            archivos_eliminados = 0
-            total_size_freed = 0
-            
-            for filename in os.listdir(pdf_dir):
-                if filename.endswith('.pdf'):
-                    filepath = os.path.join(pdf_dir, filename)
-                    if os.path.exists(filepath):
-                        stat_result = os.stat(filepath)
-                        # Eliminar archivos más antiguos de 1 día (24 horas)
-                        if (current_time - stat_result.st_mtime) > (24 * 3600):
-                            file_size = stat_result.st_size
-                            os.remove(filepath)
-                            archivos_eliminados += 1
-                            total_size_freed += file_size
-                            logger.info(f"🗑️ PDF eliminado: {filename} ({file_size} bytes)")
+            # Eliminar archivos más antiguos de 1 día (24 horas), incluidos temporales abandonados
+            archivos_eliminados, total_size_freed = await self._scan_and_delete(pdf_dir, 24 * 3600, _is_pdf_or_tmp)
             
             if archivos_eliminados > 0:
                 logger.info(f"✅ Limpieza PDFs completada: {archivos_eliminados} archivos eliminados, {total_size_freed} bytes liberados")
@@ -61,27 +136,16 @@ class AutoCleanupManager:
             cleaned_entries = await cache_manager.cleanup_expired()
             
             # También limpiar archivos huérfanos en la carpeta cache
-            cache_dir = Path("cache")
+            orphaned_files = 0
+            cache_dir = cache_manager.cache_dir
             if cache_dir.exists():
-                current_time = time.time()
-                orphaned_files = 0
-                
-                for file_path in cache_dir.glob("*"):
-                    if file_path.is_file():
-                        stat_result = file_path.stat()
-                        # Eliminar archivos más antiguos de 1 día
-                        if (current_time - stat_result.st_mtime) > (24 * 3600):
-                            try:
-                                file_path.unlink()
-                                orphaned_files += 1
-                                logger.info(f"🗑️ Archivo cache huérfano eliminado: {file_path.name}")
-                            except Exception as e:
-                                logger.error(f"⚠️ Error eliminando archivo cache {file_path}: {e}")
+                # Eliminar PDFs y temporales más antiguos de 1 día (cache_index.json no se toca)
+                orphaned_files, _ = await self._scan_and_delete(str(cache_dir), 24 * 3600, _is_cache_file)
                 
                 if orphaned_files > 0:
                     logger.info(f"✅ Archivos cache huérfanos eliminados: {orphaned_files}")
             
-            total_cleaned = cleaned_entries + (orphaned_files if 'orphaned_files' in locals() else 0)
+            total_cleaned = cleaned_entries + orphaned_files
             
             if total_cleaned > 0:
                 logger.info(f"✅ Limpieza cache completada: {total_cleaned} elementos eliminados")
@@ -128,6 +192,10 @@ class AutoCleanupManager:
         if self.is_running:
             logger.warning("⚠️ El programador ya está ejecutándose")
             return
+        
+        if not self._acquire_scheduler_lock():
+            logger.info(f"⏭️ Otro worker ejecuta la limpieza automática (pid {os.getpid()} omitido)")
+            return
             
         try:
             # Programar limpieza diaria a las 2:00 AM
@@ -156,6 +224,7 @@ class AutoCleanupManager:
             logger.info("🔄 Limpieza periódica cada 6 horas")
             
         except Exception as e:
+            self._release_scheduler_lock()
             logger.error(f"❌ Error iniciando programador: {e}")
     
     def stop_scheduler(self):
@@ -166,6 +235,7 @@ class AutoCleanupManager:
         try:
             self.scheduler.shutdown()
             self.is_running = False
+            self._release_scheduler_lock()
             logger.info("🛑 Programador de limpieza detenido")
         except Exception as e:
             logger.error(f"❌ Error deteniendo programador: {e}")
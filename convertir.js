@@ -1,40 +1,31 @@
 const puppeteer = require('puppeteer');
 const path = require('path');
 const fs = require('fs');
+const readline = require('readline');
+
+function lanzarNavegador() {
+    console.log('Iniciando Puppeteer...');
+    return puppeteer.launch({
+        headless: true,
+        args: ['--no-sandbox', '--disable-setuid-sandbox']
+    });
+}
+
+// Renderiza un archivo HTML a PDF en una pestaña nueva del navegador
+async function renderizarPDF(browser, archivoHTML, archivoPDF) {
+    const page = await browser.newPage();
 
-async function convertirHTMLaPDF(archivoHTML = 'arch.html', archivoPDF = null) {
-    let browser;
-    
     try {
-        // Si no se especifica PDF, usar el mismo nombre que HTML
-        if (!archivoPDF) {
-            const nombreBase = path.parse(archivoHTML).name;
-            archivoPDF = `${nombreBase}.pdf`;
-        }
-        
-        // Verificar que el archivo HTML existe
-        if (!fs.existsSync(archivoHTML)) {
-            throw new Error(`No se encontró el archivo: ${archivoHTML}`);
-        }
-        
-        console.log('Iniciando Puppeteer...');
-        browser = await puppeteer.launch({
-            headless: true,
-            args: ['--no-sandbox', '--disable-setuid-sandbox']
-        });
-        
-        const page = await browser.newPage();
-        
         // Cargar el archivo HTML
         const rutaCompleta = path.resolve(archivoHTML);
         const urlArchivo = `file://${rutaCompleta}`;
-        
+
         console.log(`Cargando: ${urlArchivo}`);
-        await page.goto(urlArchivo, { 
+        await page.goto(urlArchivo, {
             waitUntil: 'networkidle0',
-            timeout: 30000 
+            timeout: 30000
         });
-        
+
         // Configuración del PDF
         const opcionesPDF = {
             path: archivoPDF,
@@ -47,13 +38,35 @@ async function convertirHTMLaPDF(archivoHTML = 'arch.html', archivoPDF = null) {
                 left: '20px'
             }
         };
-        
+
         console.log('Generando PDF...');
         await page.pdf(opcionesPDF);
-        
+
         console.log(`PDF creado exitosamente: ${archivoPDF}`);
+    } finally {
+        await page.close();
+    }
+}
+
+async function convertirHTMLaPDF(archivoHTML = 'arch.html', archivoPDF = null) {
+    let browser;
+
+    try {
+        // Si no se especifica PDF, usar el mismo nombre que HTML
+        if (!archivoPDF) {
+            const nombreBase = path.parse(archivoHTML).name;
+            archivoPDF = `${nombreBase}.pdf`;
+        }
+
+        // Verificar que el archivo HTML existe
+        if (!fs.existsSync(archivoHTML)) {
+            throw new Error(`No se encontró el archivo: ${archivoHTML}`);
+        }
+
+        browser = await lanzarNavegador();
+        await renderizarPDF(browser, archivoHTML, archivoPDF);
         return true;
-        
+
     } catch (error) {
         console.error('Error al convertir:', error.message);
         return false;
@@ -64,15 +77,70 @@ async function convertirHTMLaPDF(archivoHTML = 'arch.html', archivoPDF = null) {
     }
 }
 
+// Modo servidor: un único navegador atiende peticiones JSON, una por línea de stdin.
+// Petición: {"html": ruta, "pdf": ruta}
+// Respuesta (una línea en stdout): {"success": bool, "message": texto}
+async function servidor() {
+    // stdout queda reservado para las respuestas; los logs van a stderr
+    console.log = console.error;
+
+    let browser = null;
+    const obtenerNavegador = async () => {
+        if (!browser || !browser.connected) {
+            browser = await lanzarNavegador();
+        }
+        return browser;
+    };
+
+    const responder = respuesta => process.stdout.write(JSON.stringify(respuesta) + '\n');
+    const lineas = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+
+    // Las peticiones se atienden en orden: el proceso Python envía una a la vez
+    for await (const linea of lineas) {
+        if (!linea.trim()) {
+            continue;
+        }
+        try {
+            const peticion = JSON.parse(linea);
+            if (!peticion.pdf) {
+                throw new Error('Falta la ruta del PDF');
+            }
+            if (!fs.existsSync(peticion.html)) {
+                throw new Error(`No se encontró el archivo: ${peticion.html}`);
+            }
+            await renderizarPDF(await obtenerNavegador(), peticion.html, peticion.pdf);
+            responder({ success: true, message: `PDF creado exitosamente: ${peticion.pdf}` });
+        } catch (error) {
+            console.error('Error al convertir:', error.message);
+            responder({ success: false, message: error.message });
+        }
+    }
+
+    // stdin cerrado: terminar limpiamente
+    if (browser) {
+        await browser.close();
+    }
+}
+
 // Si se ejecuta directamente
 if (require.main === module) {
-    const archivoHTML = process.argv[2] || 'arch.html';
-    const archivoPDF = process.argv[3] || null;
-    
-    convertirHTMLaPDF(archivoHTML, archivoPDF)
-        .then(exito => {
-            process.exit(exito ? 0 : 1);
-        });
+    if (process.argv[2] === '--server') {
+        servidor().then(
+            () => process.exit(0),
+            error => {
+                console.error('Error en el servidor de conversión:', error.message);
+                process.exit(1);
+            }
+        );
+    } else {
+        const archivoHTML = process.argv[2] || 'arch.html';
+        const archivoPDF = process.argv[3] || null;
+
+        convertirHTMLaPDF(archivoHTML, archivoPDF)
+            .then(exito => {
+                process.exit(exito ? 0 : 1);
+            });
+    }
 }
 
-module.exports = { convertirHTMLaPDF };
\ No newline at end of file
+module.exports = { convertirHTMLaPDF };
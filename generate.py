@@ -1,26 +1,38 @@
-import json
-from functools import wraps
 import time
 import asyncio
+import queue
+from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing.util
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import (
+    NoSuchElementException, TimeoutException, InvalidSessionIdException, NoSuchWindowException
+)
+from urllib3.exceptions import HTTPError as Urllib3HTTPError, MaxRetryError
 from webdriver_manager.chrome import ChromeDriverManager
 from dotenv import load_dotenv
 from pdf_converter import PDFConverter
-from bs4 import BeautifulSoup
 import os
+import codecs
+import tempfile
 import aiofiles
-from cache_manager import cache_manager
-import shutil
+import aiohttp
+from cache_manager import cache_manager, link_or_copy
 
 load_dotenv()
 
 # Crear carpeta para PDFs si no existe
 PDF_OUTPUT_DIR = "pdfs_generados"
+# Los reportes se nombran <PDF_PREFIX><dni><PDF_SUFFIX>
+PDF_PREFIX = "reporte_"
+PDF_SUFFIX = ".pdf"
 if not os.path.exists(PDF_OUTPUT_DIR):
     os.makedirs(PDF_OUTPUT_DIR)
     print(f"📁 Carpeta creada: {PDF_OUTPUT_DIR}")
@@ -32,27 +44,36 @@ password_s = os.getenv('PASSWORD_SELENIUM')
 button_s = os.getenv('BUTTON_SELECTOR')
 input_s = os.getenv('INPUT_SELECTOR')
 
+# Localizadores del dashboard
+_SEL_TILE_GROUP = (By.CSS_SELECTOR, "div.tile-group.quadro")
+_SEL_TITLE = (By.CSS_SELECTOR, "span.tile-group-title")
+_SEL_TILE_CONTAINER = (By.CSS_SELECTOR, "div.tile-container")
+_SEL_TILE = (By.CSS_SELECTOR, "div[data-role='tile']")
+_SEL_LABEL = (By.CSS_SELECTOR, "span.tile-label")
+_SEL_PASSWORD = (By.ID, "password")
+
 def buscar_elemento_creditos_directo(driver, texto_buscar="Créditos"):
     """
     Busca un elemento específico directamente en Selenium sin archivos intermedios
     """
+    texto_buscar = texto_buscar.lower()
     try:
         # Buscar todas las secciones tile-group
-        tile_groups = driver.find_elements(By.CSS_SELECTOR, "div.tile-group.quadro")
+        tile_groups = driver.find_elements(*_SEL_TILE_GROUP)
         
         for group in tile_groups:
             try:
                 # Buscar el título de la sección
-                title = group.find_element(By.CSS_SELECTOR, "span.tile-group-title")
+                title = group.find_element(*_SEL_TITLE)
                 if "Creditos" in title.text:
                     # Buscar el contenedor de tiles
-                    tile_container = group.find_element(By.CSS_SELECTOR, "div.tile-container")
-                    elementos = tile_container.find_elements(By.CSS_SELECTOR, "div[data-role='tile']")
+                    tile_container = group.find_element(*_SEL_TILE_CONTAINER)
+                    elementos = tile_container.find_elements(*_SEL_TILE)
                     
                     for elemento in elementos:
                         try:
-                            label = elemento.find_element(By.CSS_SELECTOR, "span.tile-label")
-                            if texto_buscar.lower() in label.text.lower():
+                            label = elemento.find_element(*_SEL_LABEL)
+                            if texto_buscar in label.text.lower():
                                 return elemento
                         except:
                             continue
@@ -63,89 +84,87 @@ def buscar_elemento_creditos_directo(driver, texto_buscar="Créditos"):
     
     return None
 
+# Construye un selector CSS único (por id o posiciones nth-child) para un elemento
+_JS_SELECTOR_CSS = """
+const partes = [];
+let nodo = arguments[0];
+while (nodo && nodo.nodeType === 1 && nodo !== document.body) {
+    if (nodo.id) {
+        partes.unshift('#' + CSS.escape(nodo.id));
+        return partes.join(' > ');
+    }
+    let indice = 1;
+    let hermano = nodo;
+    while ((hermano = hermano.previousElementSibling)) indice++;
+    partes.unshift(nodo.tagName.toLowerCase() + ':nth-child(' + indice + ')');
+    nodo = nodo.parentElement;
+}
+partes.unshift('body');
+return partes.join(' > ');
+"""
+
+def buscar_elemento_creditos_memoizado(driver, texto_buscar="Créditos"):
+    """
+    Igual que buscar_elemento_creditos_directo, pero guarda en el driver el selector
+    del tile encontrado: el layout del dashboard no cambia dentro de una sesión
+    """
+    selector = getattr(driver, "_creditos_selector", None)
+    if selector:
+        try:
+            return driver.find_element(By.CSS_SELECTOR, selector)
+        except NoSuchElementException:
+            driver._creditos_selector = None
+    
+    elemento = buscar_elemento_creditos_directo(driver, texto_buscar)
+    if elemento:
+        try:
+            driver._creditos_selector = driver.execute_script(_JS_SELECTOR_CSS, elemento)
+        except Exception as e:
+            print(f"⚠️ No se pudo memorizar el selector de Créditos: {e}")
+    return elemento
+
+# Las mismas estrategias de búsqueda del input, en orden, ejecutadas en el navegador.
+# Devuelve [elemento, estrategia] o null.
+_JS_BUSCAR_INPUT = """
+const usable = i => !i.disabled && !!(i.offsetWidth || i.offsetHeight || i.getClientRects().length)
+    && getComputedStyle(i).visibility !== 'hidden';
+const ph = i => (i.getAttribute('placeholder') || '').toUpperCase();
+const dniOContrato = i => ph(i).includes('DNI') || ph(i).includes('CONTRATO');
+const estrategias = [
+    ['placeholder', "input[placeholder*='CONTRATO'][placeholder*='DNI'][placeholder*='NOMBRE']", i => true],
+    ['clase CSS', 'input.x-form-field.x-form-text', dniOContrato],
+    ['rol/tipo', "input[type='text'][role='textbox']", i => {
+        const name = (i.getAttribute('name') || '').toLowerCase();
+        return name.includes('search') || name.includes('buscar') || dniOContrato(i);
+    }],
+    ['tabla', "table input[type='text']", dniOContrato],
+    ['ID pattern', "input[id*='search'], input[id*='input'], input[id*='field']", dniOContrato],
+    ['primer campo visible', "input[type='text']", i => i.getBoundingClientRect().top + window.scrollY < 500],
+];
+for (const [nombre, selector, filtro] of estrategias) {
+    for (const i of document.querySelectorAll(selector)) {
+        if (usable(i) && filtro(i)) return [i, nombre];
+    }
+}
+return null;
+"""
+
 def buscar_input_busqueda_robusto(driver, placeholder_texto="N° CONTRATO / DNI / NOMBRE"):
     """
     Busca el input de búsqueda de forma robusta usando múltiples estrategias
-    ya que el ID es mutable y el XPath no es confiable
+    ya que el ID es mutable y el XPath no es confiable.
+    Todas las estrategias se evalúan en una sola llamada execute_script.
     """
     try:
         print("Buscando input de búsqueda...")
         
-        # Estrategia 1: Buscar por placeholder específico
-        try:
-            elemento = driver.find_element(By.CSS_SELECTOR, f"input[placeholder*='CONTRATO'][placeholder*='DNI'][placeholder*='NOMBRE']")
-            if elemento.is_displayed() and elemento.is_enabled():
-                print(f"Input encontrado por placeholder: {elemento.get_attribute('placeholder')}")
-                return elemento
-        except:
-            pass
-        
-        # Estrategia 2: Buscar por clase CSS específica
-        try:
-            elementos = driver.find_elements(By.CSS_SELECTOR, "input.x-form-field.x-form-text")
-            for elemento in elementos:
-                if elemento.is_displayed() and elemento.is_enabled():
-                    placeholder = elemento.get_attribute('placeholder') or ''
-                    if 'CONTRATO' in placeholder.upper() or 'DNI' in placeholder.upper():
-                        print(f"Input encontrado por clase CSS: {placeholder}")
-                        return elemento
-        except:
-            pass
-        
-        # Estrategia 3: Buscar por atributos de rol y tipo
-        try:
-            elementos = driver.find_elements(By.CSS_SELECTOR, "input[type='text'][role='textbox']")
-            for elemento in elementos:
-                if elemento.is_displayed() and elemento.is_enabled():
-                    placeholder = elemento.get_attribute('placeholder') or ''
-                    name = elemento.get_attribute('name') or ''
-                    if ('search' in name.lower() or 'buscar' in name.lower() or 
-                        'CONTRATO' in placeholder.upper() or 'DNI' in placeholder.upper()):
-                        print(f"Input encontrado por rol/tipo: {placeholder}")
-                        return elemento
-        except:
-            pass
-        
-        # Estrategia 4: Buscar en estructura de tabla (más específico)
-        try:
-            # Buscar inputs dentro de tablas que contengan el texto esperado
-            tabla_inputs = driver.find_elements(By.CSS_SELECTOR, "table input[type='text']")
-            for elemento in tabla_inputs:
-                if elemento.is_displayed() and elemento.is_enabled():
-                    placeholder = elemento.get_attribute('placeholder') or ''
-                    if 'DNI' in placeholder.upper() or 'CONTRATO' in placeholder.upper():
-                        print(f"Input encontrado en tabla: {placeholder}")
-                        return elemento
-        except:
-            pass
-        
-        # Estrategia 5: Buscar por ID que contenga 'search' o 'input'
-        try:
-            elementos = driver.find_elements(By.CSS_SELECTOR, "input[id*='search'], input[id*='input'], input[id*='field']")
-            for elemento in elementos:
-                if elemento.is_displayed() and elemento.is_enabled():
-                    placeholder = elemento.get_attribute('placeholder') or ''
-                    if placeholder and ('DNI' in placeholder.upper() or 'CONTRATO' in placeholder.upper()):
-                        print(f"Input encontrado por ID pattern: {elemento.get_attribute('id')}")
-                        return elemento
-        except:
-            pass
+        encontrado = driver.execute_script(_JS_BUSCAR_INPUT)
+        if encontrado:
+            elemento, estrategia = encontrado
+            print(f"Input encontrado por {estrategia}: {elemento.get_attribute('placeholder')}")
+            return elemento
         
-        # Estrategia 6: Buscar el primer input visible de texto en la página
-        try:
-            elementos = driver.find_elements(By.CSS_SELECTOR, "input[type='text']")
-            for elemento in elementos:
-                if elemento.is_displayed() and elemento.is_enabled():
-                    # Verificar si está en una posición prominente (arriba en la página)
-                    location = elemento.location
-                    if location['y'] < 500:  # Está en la parte superior
-                        placeholder = elemento.get_attribute('placeholder') or ''
-                        print(f"Input encontrado como primer campo visible: {placeholder}")
-                        return elemento
-        except:
-            pass
-        
-        # Estrategia 7: Debugging - mostrar todos los inputs disponibles
+        # Debugging - mostrar todos los inputs disponibles
         print("=== DEBUGGING: Inputs disponibles ===")
         try:
             all_inputs = driver.find_elements(By.CSS_SELECTOR, "input")
@@ -197,24 +216,425 @@ def buscar_y_llenar_input_dni(driver, user_dni):
         driver.save_screenshot("input_error_debug.png")
         return {"error": f"Error al llenar el campo de DNI: {str(e)}"}
 
-async def selenium_dni_async(user_dni):
-    """Función asíncrona que usa Selenium para extraer datos del DNI"""
+# Pool de drivers de Chrome ya logueados que se reutilizan entre peticiones.
+# Cada proceso (incluidos los del ProcessPoolExecutor) tiene su propio pool.
+SELENIUM_POOL_SIZE = int(os.getenv('SELENIUM_POOL_SIZE', 4))
+_DRIVER_POOL = queue.Queue(maxsize=SELENIUM_POOL_SIZE)
+_DRIVER_LOCK = threading.Lock()
+_finalizer_registered = False
+# Hilos dedicados a Selenium, uno por driver del pool: no compiten con los to_thread de E/S
+_EXEC = ThreadPoolExecutor(max_workers=SELENIUM_POOL_SIZE, thread_name_prefix="selenium-")
+
+# Ruta de chromedriver resuelta una sola vez al importar (webdriver_manager consulta red/disco)
+try:
+    CHROMEDRIVER_PATH = ChromeDriverManager().install()
+except Exception as e:
+    # Sin ruta, Selenium Manager resuelve el driver al crear el Service
+    print(f"⚠️ No se pudo resolver chromedriver con webdriver_manager: {e}")
+    CHROMEDRIVER_PATH = None
+
+# Tiempo máximo de las esperas explícitas (segundos)
+WAIT_TIMEOUT = 10
+# Tabla de resultados de búsqueda
+# (equivale al XPath /html/body/div[1]/div[2]/div[2]/div[2]/div[4]/div/table//tr)
+TABLA_SELECTOR = (
+    "body > div:nth-of-type(1) > div:nth-of-type(2) > div:nth-of-type(2)"
+    " > div:nth-of-type(2) > div:nth-of-type(4) > div > table"
+)
+# Tiempo sin cambios en la tabla para dar por terminada una búsqueda sin la fila del DNI (ms)
+RESULTADO_ESTABLE_MS = 500
+
+# Antes de buscar: observa la tabla actual para reconocer después que se refrescó
+_JS_PREPARAR_BUSQUEDA = """
+if (window.__cbObservador) { window.__cbObservador.disconnect(); }
+window.__cbTabla = document.querySelector(arguments[0]);
+window.__cbTablaCambio = false;
+window.__cbUltimoCambio = performance.now();
+window.__cbObservador = new MutationObserver(() => {
+    window.__cbTablaCambio = true;
+    window.__cbUltimoCambio = performance.now();
+});
+if (window.__cbTabla) {
+    window.__cbObservador.observe(window.__cbTabla, {childList: true, subtree: true, characterData: true});
+}
+"""
+
+# Devuelve los datos de la primera fila de 9 celdas cuyo DNI es arguments[1]. Si no la hay
+# pero la tabla ya cambió tras la búsqueda y lleva arguments[2] ms estable (filas de otros
+# DNIs, mensaje de vacío o tabla vaciada), devuelve {sin_resultados: true}; si no, null
+_JS_EXTRAER_FILA = """
+const tabla = document.querySelector(arguments[0]);
+if (tabla) {
+    for (const fila of tabla.querySelectorAll('tr')) {
+        const celdas = fila.querySelectorAll('td');
+        if (celdas.length === 9 && celdas[1].innerText.trim() === arguments[1]) {
+            const texto = i => celdas[i].innerText.trim();
+            return {id: texto(0), dni: texto(1), name: texto(2), status: texto(8)};
+        }
+    }
+}
+if (tabla !== window.__cbTabla) {
+    // La tabla apareció o se reemplazó: observar la nueva
+    window.__cbObservador.disconnect();
+    window.__cbTabla = tabla;
+    window.__cbTablaCambio = true;
+    window.__cbUltimoCambio = performance.now();
+    if (tabla) {
+        window.__cbObservador.observe(tabla, {childList: true, subtree: true, characterData: true});
+    }
+}
+if (window.__cbTablaCambio && performance.now() - window.__cbUltimoCambio >= arguments[2]) {
+    return {sin_resultados: true};
+}
+return null;
+"""
+
+# Opciones de Chrome compartidas por todos los drivers
+_CHROME_OPTIONS = Options()
+_CHROME_OPTIONS.add_argument('--headless')
+_CHROME_OPTIONS.add_argument('--disable-gpu')
+_CHROME_OPTIONS.add_argument('--no-sandbox')
+_CHROME_OPTIONS.add_argument('--disable-dev-shm-usage')
+_CHROME_OPTIONS.add_argument('--incognito')
+_CHROME_OPTIONS.add_argument('--disable-background-timer-throttling')
+_CHROME_OPTIONS.add_argument('--disable-backgrounding-occluded-windows')
+_CHROME_OPTIONS.add_argument('--disable-renderer-backgrounding')
+_CHROME_OPTIONS.add_argument('--disable-extensions')
+_CHROME_OPTIONS.add_argument('--no-first-run')
+_CHROME_OPTIONS.add_argument('--mute-audio')
+# 'eager': driver.get vuelve con el DOM listo, sin esperar imágenes ni hojas de estilo
+_CHROME_OPTIONS.page_load_strategy = 'eager'
+# Solo se extrae texto: no descargar imágenes ni mostrar notificaciones
+_CHROME_OPTIONS.add_experimental_option("prefs", {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.default_content_setting_values.notifications": 2
+})
+
+def _cerrar_drivers():
+    """Cierra todos los drivers del pool (al terminar el proceso)"""
+    while True:
+        try:
+            driver = _DRIVER_POOL.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+def _registrar_cierre_drivers():
+    """Registra una vez por proceso el cierre de los drivers del pool"""
+    global _finalizer_registered
+    with _DRIVER_LOCK:
+        if not _finalizer_registered:
+            # atexit no se ejecuta en los procesos hijos de multiprocessing; Finalize sí
+            multiprocessing.util.Finalize(None, _cerrar_drivers, exitpriority=10)
+            _finalizer_registered = True
+
+def _espera(driver, timeout=WAIT_TIMEOUT):
+    """WebDriverWait con sondeo corto: avanza en cuanto la condición se cumple"""
+    return WebDriverWait(driver, timeout, poll_frequency=0.25)
+
+# Completa usuario y contraseña, notifica los cambios al formulario y envía el login
+_JS_LOGIN = """
+const usuario = document.querySelector("input.mdl-textfield__input");
+const password = document.getElementById("password");
+usuario.value = arguments[0];
+password.value = arguments[1];
+for (const campo of [usuario, password]) {
+    for (const evento of ['input', 'change']) {
+        campo.dispatchEvent(new Event(evento, {bubbles: true}));
+    }
+}
+document.getElementById("login-btn").click();
+"""
+
+def _iniciar_sesion(driver):
+    """Completa el formulario de login en una sola llamada y espera a que cargue el dashboard"""
+    driver.execute_script(_JS_LOGIN, user_s, password_s)
+    _espera(driver).until(EC.presence_of_element_located(_SEL_TILE_GROUP))
+
+def _abrir_dashboard(driver):
+    """Vuelve al dashboard; si la sesión es nueva o expiró, inicia sesión otra vez"""
+    driver.get(url1_selenium)
+    # Con carga eager get() vuelve antes de que exista el DOM útil: esperar al dashboard o al login
+    pagina = _espera(driver).until(
+        lambda d: "dashboard" if d.find_elements(*_SEL_TILE_GROUP)
+        else ("login" if d.find_elements(*_SEL_PASSWORD) else False)
+    )
+    if pagina == "login":
+        _iniciar_sesion(driver)
+
+def _crear_driver():
+    """Abre un navegador nuevo"""
+    _registrar_cierre_drivers()
+    service = Service(CHROMEDRIVER_PATH)
+    return webdriver.Chrome(service=service, options=_CHROME_OPTIONS)
+
+def _obtener_driver():
+    """Toma un driver libre del pool o crea uno nuevo"""
+    try:
+        return _DRIVER_POOL.get_nowait()
+    except queue.Empty:
+        return _crear_driver()
+
+def _devolver_driver(driver, reutilizable=True):
+    """Devuelve el driver al pool; si falló o el pool está lleno, lo cierra"""
+    if reutilizable:
+        try:
+            _DRIVER_POOL.put_nowait(driver)
+            return
+        except queue.Full:
+            pass
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+# Errores de un navegador caído o de una sesión inválida: el driver del pool ya no sirve.
+# El resto (timeouts, elementos ausentes u obsoletos, JS) son de la página, no del navegador
+_ERRORES_DRIVER = (InvalidSessionIdException, NoSuchWindowException, MaxRetryError, Urllib3HTTPError, ConnectionError)
+
+def _reiniciar_pagina(driver):
+    """Deja el driver en una página en blanco tras un error de la página; False si no responde"""
+    try:
+        driver.get("about:blank")
+        return True
+    except Exception:
+        return False
+
+def _consultar_dni(driver, user_dni):
+    """Busca el DNI en el sistema con el driver dado; las excepciones se propagan"""
+    wait = _espera(driver)
+    _abrir_dashboard(driver)
+    
+    # ✅ VERSIÓN DIRECTA - Sin archivos intermedios
+    elemento_creditos = buscar_elemento_creditos_memoizado(driver, "Créditos")
+    if elemento_creditos:
+        elemento_creditos.click()
+    else:
+        print("No se encontró el elemento Créditos")
+        return {"error": "No se pudo acceder a la sección de Créditos"}
+    
+    # Esperar a que cargue la nueva página (el buscador robusto cubre el caso de timeout)
+    try:
+        wait.until(EC.presence_of_element_located(
+            (By.CSS_SELECTOR, "input[placeholder*='DNI'], input[placeholder*='CONTRATO']")
+        ))
+    except TimeoutException:
+        print("⚠️ Timeout esperando el campo de búsqueda")
+    
+    # Usar la nueva función robusta para buscar y llenar el DNI
+    driver.execute_script(_JS_PREPARAR_BUSQUEDA, TABLA_SELECTOR)
+    resultado_input = buscar_y_llenar_input_dni(driver, user_dni)
+    if not resultado_input.get("success"):
+        return resultado_input
+    
+    # 🔹 Esperar a la fila del DNI buscado y extraerla en una sola llamada: en un driver
+    # reutilizado la tabla aún puede mostrar la búsqueda anterior. En cuanto la tabla se
+    # refresca sin esa fila, la búsqueda está vacía; si no cambia nunca, vence la espera
+    try:
+        data_dict = wait.until(
+            lambda d: d.execute_script(_JS_EXTRAER_FILA, TABLA_SELECTOR, str(user_dni), RESULTADO_ESTABLE_MS)
+        )
+    except TimeoutException:
+        data_dict = None
+
+    # Si no hay resultados
+    if not data_dict or data_dict.get("sin_resultados"):
+        return {"error": "Cliente no encontrado o sin crédito activo"}
+
+    # 🔹 Verificar si el crédito está cancelado
+    if data_dict.get("status") == "CANCELADO":
+        return {"error": "Ya canceló su crédito"}
+
+    # 🔹 El reporte HTML se descarga fuera del navegador con las cookies de la sesión
+    cookies = {c['name']: c['value'] for c in driver.get_cookies()}
+
+    return {
+        "data_dict": data_dict,
+        "cookies": cookies,
+        "success": True
+    }
+
+def selenium_dni_blocking(user_dni):
+    """
+    Operación síncrona de Selenium. Es una función de nivel de módulo para que
+    pueda ejecutarse en un ProcessPoolExecutor (debe poder serializarse con pickle).
+    Si el driver del pool está muerto se descarta y se reintenta una vez con uno nuevo;
+    tras un error de la página el driver vuelve al pool
+    """
+    driver = None
+    try:
+        driver = _obtener_driver()
+        try:
+            resultado = _consultar_dni(driver, user_dni)
+        except _ERRORES_DRIVER as e:
+            # Navegador caído o sesión inválida: descartarlo y repetir la consulta una vez
+            print(f"⚠️ Driver inutilizable ({type(e).__name__}), reintentando con uno nuevo: {user_dni}")
+            _devolver_driver(driver, reutilizable=False)
+            driver = None
+            driver = _crear_driver()
+            resultado = _consultar_dni(driver, user_dni)
+        
+        _devolver_driver(driver)
+        driver = None
+        return resultado
+        
+    except Exception as e:
+        print(f"Error en selenium_dni: {e}")
+        # Error de la página con el navegador vivo: reutilizarlo si responde a la limpieza
+        if driver is not None and not isinstance(e, _ERRORES_DRIVER) and _reiniciar_pagina(driver):
+            _devolver_driver(driver)
+            driver = None
+        return {
+            "success": False,
+            "error": str(e)
+        }
+    finally:
+        # Navegador caído o sin respuesta: no devolverlo al pool
+        if driver is not None:
+            _devolver_driver(driver, reutilizable=False)
+
+# LRU en proceso de los DNIs servidos recientemente: evita consultar cache_manager
+_HOT: "OrderedDict[str, dict]" = OrderedDict()
+_HOT_MAX = 256
+
+def _hot_get(user_dni):
+    """Devuelve la entrada reciente del DNI si no ha expirado"""
+    entrada = _HOT.get(user_dni)
+    if entrada is None:
+        return None
+    if time.time() - entrada['timestamp'] > cache_manager.max_age_hours * 3600:
+        del _HOT[user_dni]
+        return None
+    _HOT.move_to_end(user_dni)
+    return entrada
+
+def _hot_put(user_dni, pdf_path, file_size, timestamp, created_at=None):
+    """
+    Registra el PDF servido para el DNI, descartando los menos recientes.
+    timestamp es el momento en que se generó el PDF: la expiración cuenta desde ahí
+    """
+    _HOT[user_dni] = {
+        "pdf_path": pdf_path,
+        "file_size": file_size,
+        "created_at": created_at,
+        "timestamp": timestamp
+    }
+    _HOT.move_to_end(user_dni)
+    while len(_HOT) > _HOT_MAX:
+        _HOT.popitem(last=False)
+
+async def _descargar_reporte_html(id_unico, cookies, html_path, chunk_size=1 << 16):
+    """
+    Descarga el reporte HTML reutilizando las cookies de la sesión de Selenium.
+    El cuerpo se escribe por bloques en html_path, sin tenerlo entero en memoria.
+    Si el servidor declara el charset solo en Content-Type, Chromium no lo vería al abrir
+    el archivo local: en ese caso se recodifica a UTF-8 con BOM, que prevalece sobre
+    cualquier <meta charset> del documento. Sin charset en la cabecera se guardan los
+    bytes tal cual y el navegador usa el que declare el propio HTML.
+    """
+    async with aiohttp.ClientSession(cookies=cookies) as session:
+        async with session.get(
+            f"{url2_selenium}/{id_unico}?_cp=1",
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as response:
+            response.raise_for_status()
+            decoder = None
+            if response.charset:
+                try:
+                    decoder = codecs.getincrementaldecoder(response.charset)(errors='replace')
+                except LookupError:
+                    print(f"⚠️ Charset desconocido en el reporte: {response.charset}")
+            
+            async with aiofiles.open(html_path, 'wb') as f:
+                if decoder:
+                    await f.write(codecs.BOM_UTF8)
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    if decoder:
+                        chunk = decoder.decode(chunk).encode('utf-8')
+                    await f.write(chunk)
+                if decoder:
+                    await f.write(decoder.decode(b'', final=True).encode('utf-8'))
+
+# Convertidor compartido: su pool de workers limita las conversiones simultáneas
+_CONVERTER = PDFConverter()
+
+def verificar_conversor():
+    """Comprueba (una sola vez) que Node.js esté disponible para el convertidor compartido"""
+    return _CONVERTER.verificar_dependencias()
+
+async def cerrar_conversor():
+    """Cierra los workers Node del convertidor compartido (al apagar la aplicación)"""
+    await _CONVERTER.cerrar()
+
+# Limpieza de PDFs antiguos fuera del camino de la petición
+LIMPIEZA_INTERVALO = 3600
+_LAST_CLEAN = float('-inf')
+_TAREAS_LIMPIEZA = set()
+
+async def _limpiar_pdfs_antiguos():
+    try:
+        eliminados = await _CONVERTER.limpiar_pdfs_antiguos_async(PDF_OUTPUT_DIR, dias=1)
+        if eliminados:
+            print(f"🗑️ Eliminados {eliminados} PDFs antiguos")
+    except Exception as cleanup_error:
+        print(f"Advertencia en limpieza: {cleanup_error}")
+
+def _programar_limpieza():
+    """Lanza la limpieza como tarea si pasó el intervalo desde la última"""
+    global _LAST_CLEAN
+    ahora = time.monotonic()
+    if ahora - _LAST_CLEAN < LIMPIEZA_INTERVALO:
+        return
+    _LAST_CLEAN = ahora
+    tarea = asyncio.create_task(_limpiar_pdfs_antiguos())
+    # Mantener la referencia hasta que termine para que no la recolecte el GC
+    _TAREAS_LIMPIEZA.add(tarea)
+    tarea.add_done_callback(_TAREAS_LIMPIEZA.discard)
+
+async def selenium_dni_async(user_dni, executor=None, cache_result=True):
+    """
+    Función asíncrona que usa Selenium para extraer datos del DNI.
+    executor permite enviar la parte de Selenium a un pool de procesos;
+    por defecto se usa _EXEC, un pool de hilos del tamaño del pool de drivers.
+    Con cache_result=False el PDF generado no se guarda en cache y queda a cargo del
+    llamador, con cachear_resultado (p. ej. desde una BackgroundTask).
+    """
     
     try:
         print(f"🔍 Procesando DNI: {user_dni}")
         
+        # 0. DNI servido recientemente por este proceso: el reporte ya está en disco
+        hot = _hot_get(user_dni)
+        if hot and await asyncio.to_thread(os.path.exists, hot['pdf_path']):
+            print(f"📋 Cache HIT (proceso): {user_dni}")
+            return {
+                "success": True,
+                "filename": hot['pdf_path'],
+                "message": f"PDF generado exitosamente desde cache para DNI {user_dni}",
+                "cached": True,
+                "cache_created_at": hot['created_at'],
+                "file_size": hot['file_size']
+            }
+        
         # 1. Verificar cache primero
         cached_result = await cache_manager.get_cached_pdf(user_dni)
         if cached_result:
             print(f"📋 Cache HIT: {user_dni}")
-            # Copiar PDF del cache al directorio de reportes
+            # Enlazar el PDF del cache en el directorio de reportes
             cached_pdf_path = cached_result['pdf_path']
-            target_filename = os.path.join(PDF_OUTPUT_DIR, f"reporte_{user_dni}.pdf")
+            target_filename = os.path.join(PDF_OUTPUT_DIR, f"{PDF_PREFIX}{user_dni}{PDF_SUFFIX}")
             target_path = target_filename
             
             try:
-                shutil.copy2(cached_pdf_path, target_path)
+                # Hardlink en el caso común (mismo sistema de archivos); copia como respaldo.
+                # El tamaño sale de la entrada del cache: no hace falta otro stat
+                await asyncio.to_thread(link_or_copy, cached_pdf_path, target_path)
                 print(f"📋 PDF servido desde cache: {target_filename}")
+                _hot_put(user_dni, target_path, cached_result.get('file_size', 0),
+                         cached_result['timestamp'], cached_result.get('created_at'))
                 
                 return {
                     "success": True,
@@ -240,161 +660,103 @@ async def selenium_dni_async(user_dni):
             "message": f"Error en la operación de Selenium para DNI {user_dni}: {e}"
         }
     
-    
-    def _selenium_sync_operation(user_dni):
-        """Operación síncrona de Selenium que se ejecutará en un hilo separado"""
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--incognito')
-        
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
+    # 3. Las llamadas concurrentes para el mismo DNI comparten una sola generación, que
+    # nunca cachea: así da igual el cache_result de quien la inició
+    resultado = dict(await cache_manager.singleflight(
+        user_dni,
+        lambda: _generar_pdf(user_dni, executor)
+    ))
+    if cache_result:
+        await cachear_resultado(user_dni, resultado)
+    return resultado
 
-        try:
-            driver.get(url1_selenium)
+# Generaciones ya guardadas en cache por DNI (generated_at): cada una se cachea una sola vez
+# aunque varios llamadores de la misma generación compartida pidan guardarla
+_CACHEADOS: "OrderedDict[str, float]" = OrderedDict()
 
-            # 🔹 Iniciar sesión en la web
-            driver.find_element(By.XPATH, "//input[@class='mdl-textfield__input']").send_keys(user_s)
-            driver.find_element(By.XPATH, "//input[@id='password']").send_keys(password_s)
-            driver.find_element(By.XPATH, "//button[@id='login-btn']").click()
-            time.sleep(1)
-            
-            # ✅ VERSIÓN DIRECTA - Sin archivos intermedios
-            elemento_creditos = buscar_elemento_creditos_directo(driver, "Créditos")
-            if elemento_creditos:
-                elemento_creditos.click()
-                time.sleep(2)
-            else:
-                print("No se encontró el elemento Créditos")
-                return {"error": "No se pudo acceder a la sección de Créditos"}
-            
-            # Esperar a que cargue la nueva página
-            time.sleep(3)
-            
-            # Usar la nueva función robusta para buscar y llenar el DNI
-            resultado_input = buscar_y_llenar_input_dni(driver, user_dni)
-            if not resultado_input.get("success"):
-                return resultado_input
-            
-            time.sleep(2)
-            
-
-            # 🔹 Buscar en la tabla
-            filas = driver.find_elements(By.XPATH, "/html/body/div[1]/div[2]/div[2]/div[2]/div[4]/div/table//tr")
-
-            # Si no hay resultados
-            if len(filas) == 0:
-                return {"error": "Cliente no encontrado o sin crédito activo"}
-
-            # Extraer datos de la primera fila
-            data_dict = {}
-            for row in filas:
-                celdas = row.find_elements(By.XPATH, ".//td")
-                if len(celdas) == 9:
-                    data_dict = {
-                        'id': celdas[0].text,
-                        'dni': celdas[1].text,
-                        'name': celdas[2].text,
-                        'status': celdas[8].text
-                    }
-                    break
-
-            # 🔹 Verificar si el crédito está cancelado
-            if data_dict.get("status") == "CANCELADO":
-                return {"error": "Ya canceló su crédito"}
-
-            # 🔹 Descargar el reporte HTML
-            id_unico = data_dict['id']
-            driver.get(f"{url2_selenium}/{id_unico}?_cp=1")
-            time.sleep(2)
-            
-            elemento = driver.find_element(By.XPATH, "/html")
-            html_tabla = elemento.get_attribute('outerHTML')
+async def cachear_resultado(user_dni, resultado):
+    """Guarda en cache el PDF recién generado de un resultado de selenium_dni_async"""
+    if not resultado.get("success") or resultado.get("cached") or "generated_at" not in resultado:
+        return
+    if _CACHEADOS.get(user_dni) == resultado["generated_at"]:
+        return
+    _CACHEADOS[user_dni] = resultado["generated_at"]
+    _CACHEADOS.move_to_end(user_dni)
+    while len(_CACHEADOS) > _HOT_MAX:
+        _CACHEADOS.popitem(last=False)
+    
+    try:
+        await cache_manager.cache_pdf(user_dni, resultado["filename"], file_size=resultado["file_size"])
+        print(f"💾 PDF guardado en cache: {user_dni}")
+    except Exception as cache_error:
+        print(f"⚠️ Error guardando en cache: {cache_error}")
 
-            return {
-                "html_content": html_tabla,
-                "data_dict": data_dict,
-                "success": True
-            }
-            
-        except Exception as e:
-            print(f"Error en selenium_dni: {e}")
+async def _generar_pdf(user_dni, executor=None):
+    """
+    Ejecuta Selenium, descarga el reporte y lo convierte a PDF (sin consultar ni
+    escribir el cache: de eso se encarga cachear_resultado)
+    """
+    try:
+        # Ejecutar la operación de Selenium fuera del event loop
+        loop = asyncio.get_running_loop()
+        try:
+            selenium_result = await loop.run_in_executor(executor or _EXEC, selenium_dni_blocking, user_dni)
+        except BrokenProcessPool:
+            # El proceso hijo murió a mitad de la consulta: reintentar una vez (un pool
+            # que se recrea, como el de app.py, lo reemplaza al recibir el nuevo envío)
+            print(f"⚠️ Pool de procesos roto durante la consulta, reintentando: {user_dni}")
+            selenium_result = await loop.run_in_executor(executor or _EXEC, selenium_dni_blocking, user_dni)
+        
+        if not selenium_result.get("success", False):
+            return selenium_result
+        
+        data_dict = selenium_result["data_dict"]
+        # No cachear nunca el reporte de otro cliente
+        if data_dict['dni'] != str(user_dni):
             return {
                 "success": False,
-                "error": str(e)
+                "error": f"La fila obtenida ({data_dict['dni']}) no corresponde al DNI {user_dni}"
             }
-        finally:
-            if driver:
-                driver.quit()
-    
-    # Ejecutar la operación de Selenium en un hilo separado
-    loop = asyncio.get_event_loop()
-    selenium_result = await loop.run_in_executor(None, _selenium_sync_operation, user_dni)
-    
-    if not selenium_result.get("success", False):
-        return selenium_result
-    
-    try:
-        # Crear nombre único para el archivo HTML
-        html_filename = f"arch_{user_dni}.html"
-        
-        # Escribir HTML de forma asíncrona
-        async with aiofiles.open(html_filename, "w", encoding="utf-8") as archivo:
-            await archivo.write(selenium_result["html_content"])
         
         print("Generando reporte PDF...")
-        
-        # Crear instancia del convertidor
-        converter = PDFConverter()
-        data_dict = selenium_result["data_dict"]
         print(data_dict['dni'])
         
         # Definir ruta completa del PDF en la carpeta específica
-        pdf_filename = os.path.join(PDF_OUTPUT_DIR, f"reporte_{data_dict['dni']}.pdf")
+        pdf_filename = os.path.join(PDF_OUTPUT_DIR, f"{PDF_PREFIX}{data_dict['dni']}{PDF_SUFFIX}")
         
-        # Convertir HTML a PDF de forma asíncrona
-        resultado = await converter.convertir_async(
-            html_filename, 
-            pdf_filename
-        )
+        # El PDF anterior puede ser un hardlink del cache: desvincularlo para no sobrescribir ambos
+        if await asyncio.to_thread(os.path.exists, pdf_filename):
+            await asyncio.to_thread(os.remove, pdf_filename)
+        
+        # 🔹 Descargar el reporte HTML con una petición HTTP directa (sin renderizar en Chrome)
+        # a un archivo temporal, y convertirlo a PDF de forma asíncrona desde ese archivo
+        html_path = os.path.join(tempfile.gettempdir(), f"arch_{data_dict['dni']}_{os.getpid()}.html")
+        try:
+            await _descargar_reporte_html(data_dict['id'], selenium_result["cookies"], html_path)
+            resultado = await _CONVERTER.convertir_async(html_path, pdf_filename)
+        finally:
+            try:
+                await asyncio.to_thread(os.remove, html_path)
+            except OSError:
+                pass
         
         if resultado['success']:
-            # Verificar que el archivo existe y obtener su tamaño
-            if os.path.exists(pdf_filename):
-                file_size = os.path.getsize(pdf_filename)
+            # El convertidor ya verificó que el PDF existe y devuelve su tamaño
+            file_size = resultado.get('file_size')
+            if file_size is not None:
                 print(f"✅ PDF generado: {pdf_filename}")
                 print(f"📁 Tamaño: {file_size} bytes")
+                generated_at = time.time()
+                _hot_put(user_dni, pdf_filename, file_size, generated_at)
                 
-                # 3. Guardar en cache
-                try:
-                    await cache_manager.cache_pdf(user_dni, pdf_filename)
-                    print(f"💾 PDF guardado en cache: {user_dni}")
-                except Exception as cache_error:
-                    print(f"⚠️ Error guardando en cache: {cache_error}")
-                
-                # Limpiar archivo HTML temporal
-                try:
-                    if os.path.exists(html_filename):
-                        os.remove(html_filename)
-                        print(f"🗑️ Archivo HTML temporal eliminado: {html_filename}")
-                except Exception as cleanup_error:
-                    print(f"⚠️ Error eliminando HTML temporal: {cleanup_error}")
-                
-                # Opcional: limpiar PDFs antiguos de forma asíncrona
-                try:
-                    eliminados = await converter.limpiar_pdfs_antiguos_async(PDF_OUTPUT_DIR, dias=1)
-                    if eliminados:
-                        print(f"🗑️ Eliminados {eliminados} PDFs antiguos")
-                except Exception as cleanup_error:
-                    print(f"Advertencia en limpieza: {cleanup_error}")
+                # Limpiar PDFs antiguos en segundo plano, como mucho una vez por hora
+                _programar_limpieza()
                     
                 # Devolver información completa del archivo
                 return {
                     "filename": pdf_filename,
                     "file_size": file_size,
+                    "generated_at": generated_at,
                     "success": True
                 }
             else:
@@ -418,4 +780,13 @@ async def selenium_dni_async(user_dni):
 
 def selenium_dni(user_dni):
     """Wrapper síncrono para la función asíncrona"""
-    return asyncio.run(selenium_dni_async(user_dni))
\ No newline at end of file
+    return asyncio.run(selenium_dni_async(user_dni))
+
+
+async def selenium_dni_bulk(dnis, executor=None):
+    """
+    Procesa varios DNIs en paralelo. Cada uno toma su propio driver del pool,
+    así las esperas de Selenium se solapan en vez de ejecutarse en serie.
+    Devuelve los resultados en el mismo orden que dnis.
+    """
+    return await asyncio.gather(*(selenium_dni_async(dni, executor=executor) for dni in dnis))
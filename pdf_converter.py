@@ -1,74 +1,156 @@
 import os
+import json
 import asyncio
 import aiofiles
 import subprocess
 import logging
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Conversiones simultáneas por host (cada una en su propio worker Node con Chromium),
+# repartidas entre los WEB_CONCURRENCY workers de uvicorn; al menos una por proceso
+PDF_POOL_SIZE = max(1, int(os.getenv("PDF_POOL_SIZE", 8)) // max(1, int(os.getenv("WEB_CONCURRENCY", 1))))
+
 class PDFConverter:
     def __init__(self):
         self.node_path = "node"
         self.script_path = "convertir.js"
         self.timeout = 30
-        self.executor = ThreadPoolExecutor(max_workers=2)
+        # Resultado de verificar_dependencias (None = aún no comprobado)
+        self._node_ok = None
+        # Procesos Node persistentes (convertir.js --server), cada uno con su navegador
+        self.pool_size = PDF_POOL_SIZE
+        # Espera máxima por un worker libre cuando todos están ocupados
+        self.espera_worker_timeout = 60
+        self._libres = []
+        self._cupos = None
+        self._workers_loop = None
     
     def verificar_dependencias(self):
-        """Verifica que Node.js esté disponible"""
+        """Verifica que Node.js esté disponible. Se comprueba una sola vez por instancia"""
+        if self._node_ok is not None:
+            return self._node_ok
         try:
             result = subprocess.run([self.node_path, "--version"], 
                                   capture_output=True, text=True, timeout=5)
             if result.returncode == 0:
                 logger.info(f"Node.js encontrado: {result.stdout.strip()}")
-                return True
+                self._node_ok = True
             else:
                 logger.error("Node.js no está disponible")
-                return False
+                self._node_ok = False
         except Exception as e:
             logger.error(f"Error verificando Node.js: {e}")
-            return False
+            self._node_ok = False
+        return self._node_ok
     
     async def _file_exists_async(self, file_path):
-        """Verifica si un archivo existe de forma asíncrona"""
+        """
+        Verifica si un archivo existe. Es un único stat de microsegundos:
+        se llama directamente, sin pasar por un hilo del executor
+        """
         try:
-            # Usar os.path.exists en lugar de aiofiles.os.stat
-            loop = asyncio.get_event_loop()
-            exists = await loop.run_in_executor(None, os.path.exists, file_path)
-            return exists
+            return os.path.exists(file_path)
         except Exception as e:
             logger.error(f"Error verificando archivo {file_path}: {e}")
             return False
     
-    def _convertir_sync(self, html_file, pdf_file):
-        """Función síncrona para ejecutar la conversión"""
+    def _resetear_workers(self):
+        """Descarta los workers de otro event loop (p. ej. tras un asyncio.run anterior)"""
+        for worker in self._libres:
+            # El loop anterior ya no existe: no se puede esperar al proceso, solo matarlo
+            try:
+                worker.kill()
+            except Exception:
+                pass
+        self._libres = []
+        # Un cupo por worker vivo o arrancando; se devuelve siempre en _liberar_worker
+        self._cupos = asyncio.Semaphore(self.pool_size)
+        self._workers_loop = asyncio.get_running_loop()
+    
+    async def _matar_worker(self, worker):
+        """Mata el proceso y lo espera, para que no quede como zombi"""
+        try:
+            worker.kill()
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(worker.wait(), 5)
+        except Exception as e:
+            logger.error(f"No se pudo esperar al worker de conversión {worker.pid}: {e}")
+    
+    async def _obtener_worker(self):
+        """
+        Reserva un cupo del pool y devuelve un worker libre, o arranca uno nuevo.
+        Lanza asyncio.TimeoutError si no hay cupo en espera_worker_timeout segundos
+        """
+        if self._workers_loop is not asyncio.get_running_loop():
+            self._resetear_workers()
+        
+        await asyncio.wait_for(self._cupos.acquire(), self.espera_worker_timeout)
         try:
-            logger.info(f"Iniciando conversión: {html_file} -> {pdf_file}")
-            
-            # Ejecutar el comando de conversión
-            cmd = [self.node_path, self.script_path, html_file, pdf_file]
-            logger.info(f"Ejecutando comando: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=self.timeout,
-                cwd=os.getcwd()
+            while self._libres:
+                worker = self._libres.pop()
+                if worker.returncode is None:
+                    return worker
+                # El proceso terminó mientras estaba libre: recogerlo y probar otro
+                logger.warning(f"Worker de conversión terminado (código {worker.returncode})")
+                await self._matar_worker(worker)
+            
+            logger.info("Iniciando worker de conversión Node.js")
+            # stderr se hereda: los logs de Node quedan en la salida del servidor
+            return await asyncio.create_subprocess_exec(
+                self.node_path, self.script_path, "--server",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE
             )
+        except BaseException:
+            self._cupos.release()
+            raise
+    
+    async def _liberar_worker(self, worker, reutilizable):
+        """Devuelve el worker al pool o, si su estado es desconocido, lo mata; siempre libera el cupo"""
+        try:
+            if reutilizable and worker.returncode is None:
+                self._libres.append(worker)
+            else:
+                await self._matar_worker(worker)
+        finally:
+            self._cupos.release()
+    
+    async def _convertir_en_worker(self, peticion):
+        """Envía una petición JSON a un worker y espera su respuesta de una línea"""
+        try:
+            worker = await self._obtener_worker()
+        except asyncio.TimeoutError:
+            error_msg = f"Sin workers de conversión libres después de {self.espera_worker_timeout} segundos"
+            logger.error(error_msg)
+            return {"success": False, "message": error_msg}
+        except Exception as e:
+            error_msg = f"No se pudo iniciar el worker de conversión: {str(e)}"
+            logger.error(error_msg)
+            return {"success": False, "message": error_msg}
+        
+        reutilizable = False
+        try:
+            worker.stdin.write(json.dumps(peticion).encode() + b"\n")
+            await worker.stdin.drain()
+            linea = await asyncio.wait_for(worker.stdout.readline(), self.timeout)
+            if not linea:
+                raise ConnectionError("El worker de conversión terminó sin responder")
+            result = json.loads(linea)
+            reutilizable = True
             
-            if result.returncode == 0:
-                logger.info(f"Conversión exitosa. Salida: {result.stdout}")
-                return {"success": True, "message": result.stdout}
+            if result.get("success"):
+                logger.info(f"Conversión exitosa. Salida: {result.get('message')}")
             else:
-                error_msg = f"Error en conversión. Código: {result.returncode}, Error: {result.stderr}"
-                logger.error(error_msg)
-                return {"success": False, "message": error_msg}
-                
-        except subprocess.TimeoutExpired:
+                logger.error(f"Error en conversión: {result.get('message')}")
+            return result
+        
+        except asyncio.TimeoutError:
             error_msg = f"Timeout en conversión después de {self.timeout} segundos"
             logger.error(error_msg)
             return {"success": False, "message": error_msg}
@@ -76,12 +158,44 @@ class PDFConverter:
             error_msg = f"Error inesperado en conversión: {str(e)}"
             logger.error(error_msg)
             return {"success": False, "message": error_msg}
+        finally:
+            # Estado desconocido (timeout, respuesta cortada): no reutilizarlo
+            await self._liberar_worker(worker, reutilizable)
+    
+    async def cerrar(self):
+        """Cierra los workers libres (al apagar la aplicación)"""
+        if self._workers_loop is not asyncio.get_running_loop():
+            return
+        libres, self._libres = self._libres, []
+        for worker in libres:
+            try:
+                # Cerrar stdin termina el bucle de convertir.js, que cierra su navegador
+                worker.stdin.close()
+                await asyncio.wait_for(worker.wait(), 5)
+            except Exception:
+                await self._matar_worker(worker)
+    
+    def _validar_ruta_pdf(self, pdf_file):
+        """
+        El worker Node hereda el directorio de trabajo y escribe pdf_file tal cual:
+        se rechazan rutas absolutas o con '..' (el nombre incluye el DNI recibido).
+        Devuelve el mensaje de error, o None si la ruta es válida
+        """
+        if os.path.isabs(pdf_file) or ".." in os.path.normpath(pdf_file).split(os.sep):
+            return f"Ruta de PDF no permitida: {pdf_file}"
+        return None
     
     async def convertir_async(self, html_file, pdf_file):
         """Convierte HTML a PDF de forma asíncrona (compatible con Windows)"""
         try:
             logger.info(f"Iniciando conversión asíncrona: {html_file} -> {pdf_file}")
             
+            # Rechazar rutas fuera del directorio de trabajo antes de tocar el worker
+            error_msg = self._validar_ruta_pdf(pdf_file)
+            if error_msg:
+                logger.error(error_msg)
+                return {"success": False, "message": error_msg}
+            
             # Verificar dependencias
             if not self.verificar_dependencias():
                 return {"success": False, "message": "Node.js no está disponible"}
@@ -92,21 +206,19 @@ class PDFConverter:
                 logger.error(error_msg)
                 return {"success": False, "message": error_msg}
             
-            # Ejecutar conversión en un hilo separado
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                self.executor, 
-                self._convertir_sync, 
-                html_file, 
-                pdf_file
-            )
+            # Convertir en un worker Node persistente
+            result = await self._convertir_en_worker({"html": html_file, "pdf": pdf_file})
             
             if result["success"]:
                 # Verificar que el PDF se creó correctamente
-                if await self._file_exists_async(pdf_file):
-                    file_size = await self._get_file_size_async(pdf_file)
+                file_size = self._tamano_pdf(pdf_file)
+                if file_size is not None:
                     logger.info(f"PDF creado exitosamente: {pdf_file} ({file_size} bytes)")
-                    return {"success": True, "message": f"PDF generado exitosamente: {pdf_file}"}
+                    return {
+                        "success": True,
+                        "message": f"PDF generado exitosamente: {pdf_file}",
+                        "file_size": file_size
+                    }
                 else:
                     error_msg = "PDF no se creó correctamente"
                     logger.error(error_msg)
@@ -119,32 +231,54 @@ class PDFConverter:
             logger.error(error_msg)
             return {"success": False, "message": error_msg}
     
-    async def _get_file_size_async(self, file_path):
-        """Obtiene el tamaño de un archivo de forma asíncrona"""
+    def _tamano_pdf(self, pdf_file):
+        """
+        Existencia y tamaño del PDF con un único stat.
+        Devuelve None si el archivo no existe o no se puede leer
+        """
         try:
-            loop = asyncio.get_event_loop()
-            size = await loop.run_in_executor(None, lambda: os.path.getsize(file_path))
-            return size
-        except Exception as e:
-            logger.error(f"Error obteniendo tamaño de {file_path}: {e}")
-            return 0
+            return os.stat(pdf_file).st_size
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Error obteniendo tamaño de {pdf_file}: {e}")
+            return None
     
     async def limpiar_pdfs_antiguos_async(self, directorio=".", dias=1):
         """Limpia PDFs antiguos de forma asíncrona"""
         try:
             import time
-            current_time = time.time()
-            archivos_eliminados = 0
+            limite = time.time() - dias * 24 * 3600
             
-            for filename in os.listdir(directorio):
-                if filename.endswith('.pdf'):
-                    filepath = os.path.join(directorio, filename)
-                    if await self._file_exists_async(filepath):
-                        stat_result = os.stat(filepath)
-                        if (current_time - stat_result.st_mtime) > (dias * 24 * 3600):
-                            os.remove(filepath)
-                            archivos_eliminados += 1
-                            logger.info(f"PDF antiguo eliminado: {filename}")
+            # Listar y filtrar por mtime en un solo viaje al hilo (scandir reutiliza la info del directorio)
+            def _listar_antiguos():
+                antiguos = []
+                with os.scandir(directorio) as it:
+                    for e in it:
+                        if not e.name.endswith('.pdf'):
+                            continue
+                        try:
+                            if e.stat().st_mtime < limite:
+                                antiguos.append((e.name, e.path))
+                        except FileNotFoundError:
+                            # Borrado o reemplazado por otra petición mientras se recorría
+                            continue
+                return antiguos
+            antiguos = await asyncio.to_thread(_listar_antiguos)
+            
+            resultados = await asyncio.gather(
+                *(asyncio.to_thread(os.remove, ruta) for _, ruta in antiguos),
+                return_exceptions=True
+            )
+            
+            archivos_eliminados = 0
+            for (nombre, _), resultado in zip(antiguos, resultados):
+                if isinstance(resultado, FileNotFoundError):
+                    continue
+                if isinstance(resultado, Exception):
+                    logger.error(f"Error eliminando {nombre}: {resultado}")
+                    continue
+                archivos_eliminados += 1
+                logger.info(f"PDF antiguo eliminado: {nombre}")
             
             return archivos_eliminados
         except Exception as e:
@@ -161,23 +295,37 @@ class PDFConverter:
             
             # Si directorio contiene un patrón como "reporte_*.pdf", usar glob
             if "*" in directorio:
-                pattern = directorio
-                archivos = glob.glob(pattern)
+                archivos = []
+                for filepath in glob.iglob(directorio):
+                    try:
+                        archivos.append((filepath, os.stat(filepath).st_mtime))
+                    except FileNotFoundError:
+                        continue
             else:
-                # Si es un directorio, buscar PDFs en él
+                # Si es un directorio, buscar PDFs en él (scandir evita un stat extra por is_file)
                 if os.path.isdir(directorio):
-                    archivos = [os.path.join(directorio, f) for f in os.listdir(directorio) if f.endswith('.pdf')]
+                    archivos = []
+                    with os.scandir(directorio) as it:
+                        for e in it:
+                            if not (e.name.endswith('.pdf') and e.is_file()):
+                                continue
+                            try:
+                                archivos.append((e.path, e.stat().st_mtime))
+                            except FileNotFoundError:
+                                continue
                 else:
                     archivos = []
             
-            for filepath in archivos:
-                if os.path.exists(filepath):
-                    stat_result = os.stat(filepath)
-                    # Convertir minutos a segundos
-                    if (current_time - stat_result.st_mtime) > (minutos * 60):
+            # Convertir minutos a segundos
+            limite = current_time - minutos * 60
+            for filepath, mtime in archivos:
+                if mtime < limite:
+                    try:
                         os.remove(filepath)
-                        archivos_eliminados.append(os.path.basename(filepath))
-                        logger.info(f"PDF antiguo eliminado: {os.path.basename(filepath)}")
+                    except FileNotFoundError:
+                        continue
+                    archivos_eliminados.append(os.path.basename(filepath))
+                    logger.info(f"PDF antiguo eliminado: {os.path.basename(filepath)}")
             
             return archivos_eliminados
         except Exception as e:
@@ -0,0 +1,36 @@
+import asyncio
+
+import generate
+from cache_manager import PDFCacheManager
+
+
+def test_cache_hit_repetido_mismo_dni(tmp_path, monkeypatch):
+    """Tres hits seguidos del mismo DNI: el PDF sigue en su sitio y no quedan temporales"""
+    dni = "12345678"
+    salida = tmp_path / "pdfs_generados"
+    salida.mkdir()
+    origen = tmp_path / "origen.pdf"
+    origen.write_bytes(b"%PDF-1.4 prueba")
+
+    manager = PDFCacheManager(cache_dir=str(tmp_path / "cache"), max_age_hours=24)
+    monkeypatch.setattr(generate, "cache_manager", manager)
+    monkeypatch.setattr(generate, "PDF_OUTPUT_DIR", str(salida))
+
+    async def escenario():
+        assert await manager.cache_pdf(dni, str(origen))
+        resultados = []
+        for _ in range(3):
+            # Vaciar el cache del proceso para pasar siempre por el cache en disco
+            generate._HOT.clear()
+            resultados.append(await generate.selenium_dni_async(dni))
+        return resultados
+
+    resultados = asyncio.run(escenario())
+
+    destino = salida / f"{generate.PDF_PREFIX}{dni}{generate.PDF_SUFFIX}"
+    for resultado in resultados:
+        assert resultado["success"], resultado
+        assert resultado["cached"]
+        assert resultado["filename"] == str(destino)
+    assert destino.read_bytes() == origen.read_bytes()
+    assert not list(tmp_path.rglob("*.tmp"))
@@ -1,10 +1,26 @@
 import asyncio
 import aiohttp
+import sys
 import time
 import json
+from collections import Counter
 from datetime import datetime
 import psutil
 
+try:
+    import orjson
+except ImportError:  # el test también funciona sin orjson, con el json estándar
+    orjson = None
+
+# (De)serialización JSON de aiohttp: orjson si está disponible (json_serialize debe devolver str)
+if orjson is not None:
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
 # Lista de DNIs para probar
 DNIS_TEST = [
     "03016298", 
@@ -13,8 +29,11 @@ DNIS_TEST = [
 API_BASE_URL = "http://localhost:8100"
 
 async def test_single_request(session, dni, request_id):
-    """Realiza una petición individual y mide el tiempo"""
-    start_time = time.time()
+    """
+    Realiza una petición individual y mide el tiempo.
+    timestamp se guarda como epoch; save_results lo formatea en ISO al serializar.
+    """
+    t0 = time.perf_counter()
     
     try:
         async with session.post(
@@ -22,18 +41,17 @@ async def test_single_request(session, dni, request_id):
             json={"dni": dni},
             timeout=aiohttp.ClientTimeout(total=60)
         ) as response:
-            end_time = time.time()
-            duration = end_time - start_time
+            duration = time.perf_counter() - t0
             
             if response.status == 200:
-                data = await response.json()
+                data = await response.json(loads=json_loads)
                 return {
                     "request_id": request_id,
                     "dni": dni,
                     "status": "SUCCESS",
                     "duration": round(duration, 2),
                     "response": data,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": time.time()
                 }
             else:
                 error_text = await response.text()
@@ -43,7 +61,7 @@ async def test_single_request(session, dni, request_id):
                     "status": "ERROR",
                     "duration": round(duration, 2),
                     "error": f"HTTP {response.status}: {error_text}",
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": time.time()
                 }
                 
     except asyncio.TimeoutError:
@@ -53,61 +71,91 @@ async def test_single_request(session, dni, request_id):
             "status": "TIMEOUT",
             "duration": 60.0,
             "error": "Request timeout after 60 seconds",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": time.time()
         }
     except Exception as e:
-        end_time = time.time()
-        duration = end_time - start_time
+        duration = time.perf_counter() - t0
         return {
             "request_id": request_id,
             "dni": dni,
             "status": "EXCEPTION",
             "duration": round(duration, 2),
             "error": str(e),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": time.time()
         }
 
-async def test_concurrent_requests(max_concurrent=5):
-    """Ejecuta peticiones concurrentes con límite de concurrencia"""
+def crear_sesion():
+    """Sesión HTTP con pool de conexiones keep-alive, compartible entre tests"""
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, json_serialize=json_dumps)
+
+async def test_concurrent_requests(max_concurrent=5, session=None):
+    """
+    Ejecuta peticiones concurrentes con límite de concurrencia.
+    Si se pasa session se reutilizan sus conexiones; si no, se crea una para este test.
+    """
+    if session is None:
+        async with crear_sesion() as session:
+            return await test_concurrent_requests(max_concurrent, session)
+    
     print(f"🚀 Iniciando test con {len(DNIS_TEST)} DNIs")
     print(f"📊 Máximo {max_concurrent} peticiones simultáneas")
     print(f"🎯 API: {API_BASE_URL}")
     print("-" * 60)
     
     start_time = time.time()
-    results = []
     
     # Crear semáforo para limitar concurrencia
     semaphore = asyncio.Semaphore(max_concurrent)
+    completed = 0
+    # El progreso se escribe desde una sola tarea, fuera del camino de cada petición
+    progress_q = asyncio.Queue()
     
-    async def limited_request(session, dni, request_id):
-        async with semaphore:
-            return await test_single_request(session, dni, request_id)
-    
-    # Crear sesión HTTP
-    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        
-        # Crear tareas para todas las peticiones
-        tasks = [
-            limited_request(session, dni, i+1) 
-            for i, dni in enumerate(DNIS_TEST)
-        ]
-        
-        # Ejecutar todas las tareas y mostrar progreso
-        completed = 0
-        for task in asyncio.as_completed(tasks):
-            result = await task
-            results.append(result)
-            completed += 1
+    async def printer():
+        servidor_respondio = False
+        while True:
+            item = await progress_q.get()
+            if item is None:  # centinela: no quedan peticiones
+                sys.stdout.flush()
+                return
+            n, result = item
+            
+            # La primera petición exitosa sustituye al chequeo previo del servidor
+            if result["status"] == "SUCCESS" and not servidor_respondio:
+                servidor_respondio = True
+                sys.stdout.write("✅ Servidor disponible\n")
             
-            # Mostrar progreso
             status_icon = "✅" if result["status"] == "SUCCESS" else "❌"
-            print(f"{status_icon} [{completed:2d}/{len(DNIS_TEST)}] DNI: {result['dni']} - {result['status']} ({result['duration']}s)")
+            sys.stdout.write(f"{status_icon} [{n:2d}/{len(DNIS_TEST)}] DNI: {result['dni']} - {result['status']} ({result['duration']}s)\n")
+            if progress_q.empty():
+                sys.stdout.flush()
+    
+    async def limited_request(session, dni, request_id):
+        nonlocal completed
+        async with semaphore:
+            result = await test_single_request(session, dni, request_id)
+        completed += 1
+        progress_q.put_nowait((completed, result))
+        return result
+    
+    printer_task = asyncio.create_task(printer())
+    
+    # Ejecutar todas las peticiones; gather devuelve los resultados en el orden de DNIS_TEST
+    results = await asyncio.gather(*(
+        limited_request(session, dni, i+1) 
+        for i, dni in enumerate(DNIS_TEST)
+    ))
+    
+    # Esperar a que se escriba todo el progreso antes de las estadísticas
+    progress_q.put_nowait(None)
+    await printer_task
     
     end_time = time.time()
     total_duration = end_time - start_time
     
+    if results and all(r["status"] == "EXCEPTION" for r in results):
+        print("💡 Asegúrate de que el servidor esté corriendo: python app.py")
+    
     # Generar estadísticas
     generate_statistics(results, total_duration)
     
@@ -123,12 +171,19 @@ def generate_statistics(results, total_duration):
     print("=" * 60)
     
     total_requests = len(results)
-    successful = len([r for r in results if r["status"] == "SUCCESS"])
-    errors = len([r for r in results if r["status"] == "ERROR"])
-    timeouts = len([r for r in results if r["status"] == "TIMEOUT"])
-    exceptions = len([r for r in results if r["status"] == "EXCEPTION"])
     
-    durations = [r["duration"] for r in results if r["status"] == "SUCCESS"]
+    # Una sola pasada: conteo por estado y duraciones de las exitosas
+    counts = Counter()
+    durations = []
+    for r in results:
+        counts[r["status"]] += 1
+        if r["status"] == "SUCCESS":
+            durations.append(r["duration"])
+    
+    successful = counts["SUCCESS"]
+    errors = counts["ERROR"]
+    timeouts = counts["TIMEOUT"]
+    exceptions = counts["EXCEPTION"]
     
     print(f"📊 Total de peticiones: {total_requests}")
     print(f"✅ Exitosas: {successful} ({successful/total_requests*100:.1f}%)")
@@ -158,11 +213,19 @@ def save_results(results, total_duration):
             "total_duration": total_duration,
             "api_url": API_BASE_URL
         },
-        "results": results
+        "results": [
+            {**r, "timestamp": datetime.fromtimestamp(r["timestamp"]).isoformat()}
+            for r in results
+        ]
     }
     
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(test_summary, f, indent=2, ensure_ascii=False)
+    if orjson is not None:
+        # orjson serializa a bytes UTF-8 en C; se escriben directamente
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(test_summary, option=orjson.OPT_INDENT_2))
+    else:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(test_summary, f, indent=2, ensure_ascii=False)
     
     print(f"\n💾 Resultados guardados en: {filename}")
 
@@ -171,25 +234,15 @@ async def main():
     print("🧪 TEST DE PETICIONES SIMULTÁNEAS")
     print("=" * 60)
     
-    # Verificar que el servidor esté corriendo
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{API_BASE_URL}/") as response:
-                if response.status == 200:
-                    print("✅ Servidor disponible")
-                else:
-                    print(f"⚠️ Servidor responde con código: {response.status}")
-    except Exception as e:
-        print(f"❌ Error conectando al servidor: {e}")
-        print("💡 Asegúrate de que el servidor esté corriendo: python app.py")
-        return
-    
-    # Ejecutar test con diferentes niveles de concurrencia
-    for concurrency in [8]:
-        print(f"\n🔄 Ejecutando test con concurrencia: {concurrency}")
-        await test_concurrent_requests(max_concurrent=concurrency)
-        print("\n" + "⏸️" * 20 + " PAUSA " + "⏸️" * 20)
-        await asyncio.sleep(2)  # Pausa entre tests
+    # Una sola sesión para todo: las conexiones keep-alive se reutilizan entre tests
+    async with crear_sesion() as session:
+        # Ejecutar test con diferentes niveles de concurrencia
+        # (sin chequeo previo: los errores de conexión aparecen en la primera petición real)
+        for concurrency in [8]:
+            print(f"\n🔄 Ejecutando test con concurrencia: {concurrency}")
+            await test_concurrent_requests(max_concurrent=concurrency, session=session)
+            print("\n" + "⏸️" * 20 + " PAUSA " + "⏸️" * 20)
+            await asyncio.sleep(2)  # Pausa entre tests
 
 def check_system_resources():
     cpu_percent = psutil.cpu_percent(interval=1)
@@ -209,7 +262,7 @@ async def test_with_cache_warmup():
     # DNIs para calentar cache
     warmup_dnis = ["42912930", "43934955", "72125803"]
     
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60), json_serialize=json_dumps) as session:
         # Calentar cache secuencialmente
         for i, dni in enumerate(warmup_dnis):
             print(f"🔥 Calentando cache: {dni}")
@@ -218,11 +271,11 @@ async def test_with_cache_warmup():
             await asyncio.sleep(1)  # Pausa entre requests
     
     print("\n📊 Verificando estadísticas de cache...")
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(json_serialize=json_dumps) as session:
         try:
             async with session.get(f"{API_BASE_URL}/cache/stats") as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = await response.json(loads=json_loads)
                     if data.get('success'):
                         stats = data['stats']
                         print(f"📋 Cache: {stats['valid_entries']} entradas válidas")
@@ -238,9 +291,20 @@ async def test_with_cache_warmup():
     # Ahora ejecutar test normal que debería usar cache
     await test_concurrent_requests(max_concurrent=4)  # Usar concurrencia más baja
 
+def usar_event_loop_rapido():
+    """Usa uvloop (winloop en Windows) si está instalado; si no, el loop estándar de asyncio"""
+    try:
+        if sys.platform == "win32":
+            import winloop as loop_rapido
+        else:
+            import uvloop as loop_rapido
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(loop_rapido.EventLoopPolicy())
+
 if __name__ == "__main__":
     # Agregar opción para test con cache
-    import sys
+    usar_event_loop_rapido()
     if len(sys.argv) > 1 and sys.argv[1] == "--with-cache":
         asyncio.run(test_with_cache_warmup())
     else: